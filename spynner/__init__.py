@@ -1,2 +1,3 @@
 #!/usr/bin/python
 from browser import *
+from pool import BrowserPool, PoolJob
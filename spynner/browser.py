@@ -19,8 +19,15 @@ Spynner is a stateful programmatic web-browser module for Python with
 Javascript/AJAX support. It is build upon the PyQtWebKit framework.   
 """
 
+import collections
 import itertools
+import datetime
+import logging
+import threading
+import Queue
 import cookielib
+import sqlite3
+import json
 import tempfile
 import urlparse
 import urllib2
@@ -30,17 +37,30 @@ import re
 import os
 from StringIO import StringIO
 
+import sip
 from PyQt4.QtCore import SIGNAL, QUrl, QEventLoop, QString, Qt, QCoreApplication
-from PyQt4.QtCore import QSize, QDateTime, QVariant
+from PyQt4.QtCore import QSize, QDateTime, QVariant, QTimer, QObject
+from PyQt4.QtCore import pyqtSlot, pyqtProperty
+from PyQt4.QtCore import QIODevice
 from PyQt4.QtGui import QApplication, QImage, QPainter, QRegion, QAction
 from PyQt4.QtNetwork import QNetworkCookie, QNetworkAccessManager, QNetworkReply
-from PyQt4.QtNetwork import QNetworkCookieJar, QNetworkRequest
-from PyQt4.QtWebKit import QWebPage, QWebView, QWebFrame
+from PyQt4.QtNetwork import QNetworkCookieJar, QNetworkRequest, QNetworkDiskCache
+from PyQt4.QtWebKit import QWebPage, QWebView, QWebFrame, QWebSettings
+from PyQt4.QtWebKit import qWebKitVersion
 from PyQt4.QtNetwork import QNetworkProxy
 
+from metrics import Metrics, process_metrics
+
 # Debug levels
 ERROR, WARNING, INFO, DEBUG = range(4)
 
+_logging_levels = {
+    ERROR: logging.ERROR, 
+    WARNING: logging.WARNING, 
+    INFO: logging.INFO, 
+    DEBUG: logging.DEBUG,
+}
+
 class Browser:
     """
     Stateful programmatic web browser class based upon QtWebKit.   
@@ -61,14 +81,31 @@ class Browser:
     """@ivar: User agent for requests (see QWebPage::userAgentForUrl for details)"""
     jslib = "_jQuery"
     """@ivar: Library name for jQuery library injected by default to pages."""
+    prefetch_soup = False
+    """@ivar: If True, the L{soup} is parsed in a background thread as soon 
+    as a page is loaded."""
+    lazy_jquery = False
+    """@ivar: If True, jQuery is not injected to every document but only to 
+    the main frame when a method that needs it (L{click}, L{fill}, ...) 
+    is called. Call L{inject_jquery} before using it in L{runjs}."""
     download_directory = "."
     """@ivar: Directory where downloaded files will be stored."""    
+    download_chunk_size = 64 * 1024
+    """@ivar: Size (bytes) of the chunks read from download streams."""    
+    record_requests = False
+    """@ivar: If True, the details of every request (timings, headers, 
+    status) are recorded in L{requests} (see L{export_har})."""
+    max_recorded_requests = 1000
+    """@ivar: Maximum number of requests kept in L{requests}."""
+    snapshot_threads = 2
+    """@ivar: Threads used to encode snapshots (see L{snapshot_async})."""    
+    snapshot_queue_size = 8
+    """@ivar: Maximum number of snapshots waiting to be encoded."""    
     debug_stream = sys.stderr
     """@ivar: File-like stream where debug output will be written."""
     debug_level = ERROR
-    """@ivar: Debug verbose level (L{ERROR}, L{WARNING}, L{INFO} or L{DEBUG})."""    
-    event_looptime = 0.01
-    """@ivar: Event loop dispatcher loop delay (seconds)."""
+    """@ivar: Debug verbose level (L{ERROR}, L{WARNING}, L{INFO} or L{DEBUG}).
+    Lines above this level are discarded before being formatted."""    
     
     _javascript_files = ["jquery.min.js", "jquery.simulate.js"]
 
@@ -77,17 +114,26 @@ class Browser:
         os.path.join(sys.prefix, "share/spynner/javascript"),
     ]
     
-    def __init__(self, qappargs=None, debug_level=None):
+    def __init__(self, qappargs=None, debug_level=None, profile=None):
         """        
         Init a Browser instance.
         
-        @param qappargs: Arguments for QApplication constructor.
+        @param qappargs: Arguments for QApplication constructor (only used
+                         by the first Browser created in the process).
         @param debug_level: Debug level logging (L{ERROR} by default)
+        @param profile: Resource policy profile. Use C{"fast"} to block 
+                        images, fonts, media and stylesheets 
+                        (see L{set_resource_policy}).
         """ 
-        self.application = QApplication(qappargs or [])
-        """PyQt4.QtGui.Qapplication object."""
+        self.application = _get_application(qappargs)
+        """PyQt4.QtGui.Qapplication object (shared by all browsers)."""
         if debug_level is not None:
             self.debug_level = debug_level
+        self.logger = logging.LoggerAdapter(_logger, {"spynner_browser": self})
+        """logging.LoggerAdapter for debug lines. All browsers share the 
+        C{spynner.browser} logger, so the usual logging configuration 
+        applies. Lines up to L{debug_level} are also written to 
+        L{debug_stream}."""
         self.webpage = QWebPage()
         """PyQt4.QtWebKit.QWebPage object."""
         self.webpage.userAgentForUrl = self._user_agent_for_url
@@ -96,15 +142,23 @@ class Browser:
         self.webview = None
         """PyQt4.QtWebKit.QWebView object."""        
         self._url_filter = None
+        self._url_rules = None
         self._html_parser = None
+        self._snapshot_array = None
+        self._soup_cache = None
+        self._soup_thread = None
+        self._soup_lock = threading.Lock()
             
         # Javascript
-        directory = _first(self._javascript_directories, os.path.isdir)
-        if not directory:
-            raise SpynnerError("Cannot find javascript directory: %s" %
-                self._javascript_directories)           
-        self.javascript = "".join(open(os.path.join(directory, fn)).read() 
-            for fn in self._javascript_files)
+        self.javascript = _get_javascript(self._javascript_directories,
+            self._javascript_files)
+        self._jquery_injected = False
+        self._dom_version = 0
+        self._html_cache = None
+        self._bridge = self._connect_frame(self.webframe)
+        self.webpage.connect(self.webpage,
+            SIGNAL("frameCreated(QWebFrame *)"),
+            self._connect_frame)
 
         self.webpage.javaScriptAlert = self._javascript_alert                
         self.webpage.javaScriptConsoleMessage = self._javascript_console_message
@@ -130,13 +184,38 @@ class Browser:
         self.manager.connect(self.manager,
             SIGNAL('authenticationRequired(QNetworkReply *, QAuthenticator *)'),
             self._on_authentication_required)   
+        self._http_authentication_callback = None
+        self._http_credentials = {}
+        self._pending_storage = {}
+        self.cache = None
+        """PyQt4.QtNetwork.QNetworkDiskCache object (see L{enable_cache})."""
+        self.cache_hits = 0
+        """Replies served from the cache."""
+        self.cache_misses = 0
+        """Replies not served from the cache (only counted if enabled)."""
+        self._cache_static_assets = False
+        self._blocked_resources = set()
+        self.resource_stats = _get_resource_stats()
+        """Statistics of the resource policy on the current page (see 
+        L{set_resource_policy})."""
         self._operation_names = dict(
             (getattr(QNetworkAccessManager, s + "Operation"), s.lower()) 
             for s in ("Get", "Head", "Post", "Put"))
                 
         # Webpage slots         
         self._load_status = None
-        self._replies = 0
+        self._requests_count = 0
+        self._request_mark = 0
+        self._inflight_requests = {}
+        self._finished_requests = collections.deque(maxlen=1000)
+        self._last_network_activity = time.time()
+        self.requests = collections.deque(maxlen=self.max_recorded_requests)
+        """L{RequestRecord} objects of the requests made since the current
+        page started loading (only if L{record_requests} is enabled)."""
+        self._page_load_times = (None, None)
+        self.metrics = Metrics(parent=process_metrics)
+        """L{Metrics<spynner.metrics.Metrics>} of the browser (also 
+        added to C{spynner.metrics.process_metrics})."""
         self.webpage.setForwardUnsupportedContent(True)
         self.webpage.connect(self.webpage,
             SIGNAL('unsupportedContent(QNetworkReply *)'), 
@@ -147,105 +226,214 @@ class Browser:
         self.webpage.connect(self.webpage, 
             SIGNAL("loadStarted()"),
             self._on_load_started)
+        if profile:
+            if profile not in _resource_profiles:
+                raise SpynnerError("Unknown profile: %s" % profile)
+            self.set_resource_policy(_resource_profiles[profile])
 
-    def _events_loop(self, wait=None):
-        if wait is None:
-            wait = self.event_looptime
-        self.application.processEvents()
-        time.sleep(wait)        
-                        
     def _on_load_started(self):
         self._load_status = None
+        self._on_dom_changed()
+        self.resource_stats = _get_resource_stats()
+        self.requests = collections.deque(maxlen=self.max_recorded_requests)
+        self._page_load_times = (time.time(), None)
         self._debug(INFO, "Page load started")            
     
     def _on_manager_ssl_errors(self, reply, errors):
         url = unicode(reply.url().toString())
         if self.ignore_ssl_errors:
-            self._debug(WARNING, "SSL certificate error ignored: %s" % url)
+            self._debug(WARNING, "SSL certificate error ignored: %s", url)
             reply.ignoreSslErrors()
         else:
-            self._debug(WARNING, "SSL certificate error: %s" % url)
+            self._debug(WARNING, "SSL certificate error: %s", url)
 
     def _on_authentication_required(self, reply, authenticator):
         url = unicode(reply.url().toString())
         realm = unicode(authenticator.realm())
-        self._debug("HTTP auth required: %s (realm: %s)" % (url, realm))
+        self._debug(INFO, "HTTP auth required: %s (realm: %s)", url, realm)
+        key = (unicode(reply.url().host()), realm)
+        if key in self._http_credentials:
+            # Credentials restored from a session are tried only once
+            if authenticator.user().isEmpty():
+                user, password = self._http_credentials[key]
+                self._debug(INFO, "Using session HTTP credentials: %s", user)
+                authenticator.setUser(user)
+                authenticator.setPassword(password)
+                return
+            del self._http_credentials[key]
         if not self._http_authentication_callback:
             self._debug(WARNING, "HTTP auth required, but no callback defined")
             return        
         credentials = self._http_authentication_callback(url, realm)        
         if credentials:            
             user, password = credentials
-            self._debug(INFO, "callback returned HTTP credentials: %s/%s" % 
-                (user, "*"*len(password)))
+            self._debug(INFO, "callback returned HTTP credentials: %s/%s", 
+                user, "*"*len(password))
             authenticator.setUser(user)
             authenticator.setPassword(password)
+            self._http_credentials[key] = (user, password)
         else:
             self._debug(WARNING, "HTTP auth callback returned no credentials")
         
     def _manager_create_request(self, operation, request, data):
         url = unicode(request.url().toString())
         operation_name = self._operation_names[operation].upper()
-        self._debug(INFO, "Request: %s %s" % (operation_name, url))
-        for h in request.rawHeaderList():
-            self._debug(DEBUG, "  %s: %s" % (h, request.rawHeader(h)))
+        self._debug(INFO, "Request: %s %s", operation_name, url)
+        if self._debug_enabled(DEBUG):
+            for h in request.rawHeaderList():
+                self._debug(DEBUG, "  %s: %s", h, request.rawHeader(h))
+        # Downloads explicitly requested are never blocked
+        is_download = request.attribute(_download_attribute).toBool()
+        if not is_download and self._is_request_blocked(operation, request, url):
+            reply = _BlockedReply(self.manager, request, operation)
+        else:
+            if self._cache_static_assets and _is_static_asset(url):
+                request.setAttribute(QNetworkRequest.CacheLoadControlAttribute,
+                    QVariant(QNetworkRequest.PreferCache))
+            reply = QNetworkAccessManager.createRequest(self.manager, 
+                operation, request, data)
+        self._requests_count += 1
+        record = RequestRecord(self._requests_count, 
+            self._operation_names[operation], url)
+        recorded = self.record_requests
+        if recorded:
+            record.initiator = _get_request_initiator(request)
+            record.request_headers = [(str(h), str(request.rawHeader(h))) 
+                for h in request.rawHeaderList()]
+            record.request_size = (data.size() if data else 0)
+            self.requests.append(record)
+        if not isinstance(reply, _BlockedReply) and \
+                (recorded or (self._blocked_resources and not is_download)):
+            reply.connect(reply, SIGNAL("metaDataChanged()"),
+                lambda: self._on_reply_metadata_changed(reply, 
+                    (record if recorded else None), not is_download))
+            if recorded:
+                reply.connect(reply, SIGNAL("downloadProgress(qint64, qint64)"),
+                    lambda received, total: setattr(record, "size", received))
+        self._inflight_requests[reply] = record
+        self._last_network_activity = record.started
+        return reply
+
+    def _is_request_blocked(self, operation, request, url):
+        if self._url_rules and self._url_rules.match(url):
+            self._debug(INFO, "URL blocked: %s", url)
+            return True
         if self._url_filter:
             if self._url_filter(self._operation_names[operation], url) is False:
-                self._debug(INFO, "URL filtered: %s" % url)
-                request.setUrl(QUrl("about:blank"))
+                self._debug(INFO, "URL filtered: %s", url)
+                return True
             else:
-                self._debug(DEBUG, "URL not filtered: %s" % url)
-        reply = QNetworkAccessManager.createRequest(self.manager, operation, request, data)
-        return reply
+                self._debug(DEBUG, "URL not filtered: %s", url)
+        if self._blocked_resources:
+            resource = _get_request_resource_type(request, url)
+            if resource in self._blocked_resources:
+                self._debug(INFO, "Resource blocked (%s): %s", resource, url)
+                self.resource_stats["blocked_requests"] += 1
+                return True
+        return False
+
+    def _on_reply_metadata_changed(self, reply, record, check_blocked):
+        content_type = unicode(reply.header(
+            QNetworkRequest.ContentTypeHeader).toString())
+        if record:
+            if record.first_byte is None:
+                record.first_byte = time.time()
+            status, ok = reply.attribute(
+                QNetworkRequest.HttpStatusCodeAttribute).toInt()
+            if ok:
+                record.status = status
+                record.status_text = unicode(reply.attribute(
+                    QNetworkRequest.HttpReasonPhraseAttribute).toString())
+            record.content_type = content_type
+            record.response_headers = [(str(h), str(reply.rawHeader(h))) 
+                for h in reply.rawHeaderList()]
+        if not self._blocked_resources or not check_blocked:
+            return
+        resource = _get_content_type_resource_type(content_type)
+        if resource not in self._blocked_resources or not reply.isRunning():
+            return
+        url = unicode(reply.url().toString())
+        self._debug(INFO, "Resource aborted (%s): %s", resource, url)
+        size, ok = reply.header(QNetworkRequest.ContentLengthHeader).toLongLong()
+        self.resource_stats["aborted_requests"] += 1
+        if ok:
+            self.resource_stats["aborted_bytes"] += max(0, size - reply.bytesAvailable())
+        reply.abort()
 
     def _on_reply(self, reply):
-        self._replies += 1
+        record = self._inflight_requests.pop(reply, None)
+        from_cache = reply.attribute(
+            QNetworkRequest.SourceIsFromCacheAttribute).toBool()
+        if record:
+            record.finished = time.time()
+            record.error = reply.error()
+            record.from_cache = from_cache
+            self._finished_requests.append(record)
+            self._last_network_activity = record.finished
+            self.metrics.inc("requests_total")
+            size = record.size
+            if not size:
+                # Requests not recorded: Content-Length, if any
+                length, ok = reply.header(
+                    QNetworkRequest.ContentLengthHeader).toLongLong()
+                size = (length if ok else 0)
+            self.metrics.inc("bytes_received_total", size)
+            self.metrics.observe("request_seconds", record.elapsed)
+            if record.error:
+                self.metrics.inc("request_errors_total")
+        if self.cache and reply.operation() == QNetworkAccessManager.GetOperation:
+            if from_cache:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+        _wake_up()
         url = unicode(reply.url().toString())
         if reply.error():
-            self._debug(WARNING, "Reply error: %s - %d (%s)" % 
-                (url, reply.error(), reply.errorString()))
+            self._debug(WARNING, "Reply error: %s - %d (%s)", 
+                url, reply.error(), reply.errorString())
         else:
-            self._debug(INFO, "Reply successful: %s" % url)
-        for header in reply.rawHeaderList():
-            self._debug(DEBUG, "  %s: %s" % (header, reply.rawHeader(header)))
+            self._debug(INFO, "Reply successful: %s", url)
+        if self._debug_enabled(DEBUG):
+            for header in reply.rawHeaderList():
+                self._debug(DEBUG, "  %s: %s", header, reply.rawHeader(header))
 
     def _on_unsupported_content(self, reply, outfd=None):
         if not reply.error():
             self._start_download(reply, outfd)
         else:            
-            self._debug(ERROR, "Error on unsupported content: %s" % reply.errorString())
+            self._debug(ERROR, "Error on unsupported content: %s", reply.errorString())
                              
     def _javascript_alert(self, webframe, message):
-        self._debug(INFO, "Javascript alert: %s" % message)
+        self._debug(INFO, "Javascript alert: %s", message)
         if self.webview:
             QWebPage.javaScriptAlert(self.webpage, webframe, message)
         
     def _javascript_console_message(self, message, line, sourceid):
         if line:
-            self._debug(INFO, "Javascript console (%s:%d): %s" %
-                (sourceid, line, message))
+            self._debug(INFO, "Javascript console (%s:%d): %s",
+                sourceid, line, message)
         else:
-            self._debug(INFO, "Javascript console: %s" % message)
+            self._debug(INFO, "Javascript console: %s", message)
 
     def _javascript_confirm(self, webframe, message):
         smessage = unicode(message)
         url = webframe.url()
-        self._debug(INFO, "Javascript confirm (webframe url = %s): %s" % 
-            (url, smessage))
+        self._debug(INFO, "Javascript confirm (webframe url = %s): %s", 
+            url, smessage)
         if self._javascript_confirm_callback:
             value = self._javascript_confirm_callback(url, smessage)
-            self._debug(INFO, "Javascript confirm callback returned %s" % value)
+            self._debug(INFO, "Javascript confirm callback returned %s", value)
             return value 
         return QWebPage.javaScriptConfirm(self.webpage, webframe, message)
 
     def _javascript_prompt(self, webframe, message, defaultvalue, result):
         url = webframe.url()
         smessage = unicode(message)
-        self._debug(INFO, "Javascript prompt (webframe url = %s): %s" % 
-            (url, smessage))
+        self._debug(INFO, "Javascript prompt (webframe url = %s): %s", 
+            url, smessage)
         if self._javascript_prompt_callback:
             value = self._javascript_prompt_callback(url, smessage, defaultvalue)
-            self._debug(INFO, "Javascript prompt callback returned: %s" % value)
+            self._debug(INFO, "Javascript prompt callback returned: %s", value)
             if value in (False, None):
                 return False
             result.clear()
@@ -254,14 +442,80 @@ class Browser:
         return QWebPage.javaScriptPrompt(self.webpage, webframe, message,
             defaultvalue, result)
         
+    def _connect_frame(self, webframe):
+        bridge = _JavascriptBridge(self, webframe)
+        webframe.connect(webframe,
+            SIGNAL("javaScriptWindowObjectCleared()"),
+            bridge.on_window_object_cleared)
+        return bridge
+
+    def _on_javascript_window_cleared(self, webframe, bridge):
+        webframe.addToJavaScriptWindowObject("_spynner", bridge)
+        if self._pending_storage:
+            storage = self._pending_storage.pop(_get_url_origin(webframe.url()), None)
+            if storage:
+                webframe.evaluateJavaScript(_restore_storage_jscode % 
+                    json.dumps(storage))
+        if webframe == self.webframe:
+            self._jquery_injected = False
+            self._on_dom_changed()
+            webframe.evaluateJavaScript(_dom_observer_jscode)
+        if not self.lazy_jquery:
+            # jQuery needs a document element, so wait for the DOM to be ready
+            jscode = "(function(bridge) {document.addEventListener(" + \
+              "'DOMContentLoaded', function() {bridge.injectJQuery();}, false);" + \
+              "})(_spynner);"
+            webframe.evaluateJavaScript(jscode)
+
+    def _on_dom_changed(self):
+        self._dom_version += 1
+        self._bridge.dom_dirty = True
+        _wake_up()
+
+    def _wait_for_dom(self, condition, timeout):
+        def _check():
+            # Re-arm the DOM observer so the next change wakes us up
+            self._bridge.dom_dirty = False
+            return condition()
+        _wait_for(_check, timeout)
+
+    def _inject_jquery(self, webframe):
+        # Keep the jQuery of the page (and its plugins) if it has one
+        page_jquery = webframe.evaluateJavaScript(
+            "typeof window.jQuery != 'undefined'").toBool()
+        jscode = "var %s = jQuery.noConflict(%s);" % (self.jslib, 
+            ("true" if page_jquery else "false"))
+        webframe.evaluateJavaScript(self.javascript + jscode)
+        if webframe == self.webframe:
+            self._jquery_injected = True
+
     def _on_webview_destroyed(self, window):
         self.webview = None
+        _wake_up()
                                              
     def _on_load_finished(self, successful):        
         self._load_status = successful  
+        self._page_load_times = (self._page_load_times[0], time.time())
+        if successful:
+            self.metrics.inc("pages_loaded_total")
+        else:
+            self.metrics.inc("page_load_failures_total")
+        if self._page_load_times[0]:
+            self.metrics.observe("page_load_seconds", 
+                self._page_load_times[1] - self._page_load_times[0])
+        self._on_dom_changed()
+        if "image" in self._blocked_resources:
+            # Images not loaded by the page settings never reach the manager
+            sources = set(unicode(element.attribute("src")) for element in
+                self.webframe.findAllElements("img[src]").toList())
+            self.resource_stats["blocked_requests"] += len(sources)
+        if successful and self.prefetch_soup and self._html_parser:
+            self._start_soup_prefetch()
         status = {True: "successful", False: "error"}[successful]
-        self._debug(INFO, "Page load finished (%d bytes): %s (%s)" % 
-            (len(self.html), self.url, status))
+        if self._debug_enabled(INFO):
+            self._debug(INFO, "Page load finished (%d bytes): %s (%s)", 
+                len(self.html), self.url, status)
+        _wake_up()
 
     def _get_filepath_for_url(self, url):
         urlinfo = urlparse.urlsplit(url)
@@ -271,72 +525,203 @@ class Browser:
             os.makedirs(os.path.dirname(path))
         return path
 
-    def _start_download(self, reply, outfd):
+    def _start_download(self, reply, outfd, progress=None, offset=0):
         def _on_ready_read():
-            data = reply.readAll()
-            if not hasattr(reply, "downloaded_nbytes"):
-                reply.downloaded_nbytes = 0
-            reply.downloaded_nbytes += len(data)
-            outfd.write(data)
-            self._debug(DEBUG, "Read from download stream (%d bytes): %s" 
-                % (len(data), url))
-        def _on_network_error():
-            self.debug(ERROR, "Network error on download: %s" % url)
+            if state["skip"] is None:
+                state["http_error"] = (_get_http_status(reply) >= 400)
+                state["skip"] = _get_download_skip(reply, offset)
+                state["total"] = _get_download_total(reply, offset)
+            if state["http_error"]:
+                # The body of an HTTP error is not data of the file
+                reply.readAll()
+                return
+            while reply.bytesAvailable() > 0:
+                data = reply.read(self.download_chunk_size)
+                if state["skip"]:
+                    nskip = min(len(data), state["skip"])
+                    data = data[nskip:]
+                    state["skip"] -= nskip
+                reply.downloaded_nbytes += len(data)
+                outfd.write(data)
+                self._debug(DEBUG, "Read from download stream (%d bytes): %s", 
+                    len(data), url)
+            if progress:
+                elapsed = time.time() - itime
+                rate = (reply.downloaded_nbytes / elapsed if elapsed else None)
+                progress(offset + reply.downloaded_nbytes, state["total"], rate)
+        def _on_network_error(code):
+            self._debug(ERROR, "Network error on download: %s", url)
         def _on_finished():
-            self._debug(INFO, "Download finished: %s" % url)
+            self._debug(INFO, "Download finished: %s", url)
+            if close:
+                outfd.close()
         url = unicode(reply.url().toString())
-        if outfd is None:
+        itime = time.time()
+        state = dict(skip=None, total=None, http_error=False)
+        close = (outfd is None)
+        if close:
             path = self._get_filepath_for_url(url)
             outfd = open(path, "wb")            
+        reply.downloaded_nbytes = 0
+        # Data is read as soon as it arrives, a limited buffer makes the
+        # connection stall if the output stream is slow.
+        reply.setReadBufferSize(4 * self.download_chunk_size)
         reply.connect(reply, SIGNAL("readyRead()"), _on_ready_read)
-        reply.connect(reply, SIGNAL("NetworkError()"), _on_network_error)
+        reply.connect(reply, SIGNAL("error(QNetworkReply::NetworkError)"), 
+            _on_network_error)
         reply.connect(reply, SIGNAL("finished()"), _on_finished)
-        self._debug(INFO, "Start download: %s" % url)
+        self._debug(INFO, "Start download: %s", url)
 
-    def _wait_load(self, timeout=None):
-        self._events_loop(0.0)
-        if self._load_status is not None:
-            load_status = self._load_status
-            self._load_status = None
-            return load_status        
+    def _count_download(self, nbytes, itime):
+        """Update the metrics for a download started at itime."""
+        self.metrics.inc("downloads_total")
+        self.metrics.inc("download_bytes_total", nbytes)
+        self.metrics.observe("download_seconds", time.time() - itime)
+
+    def _download(self, url, outfd, progress=None, offset=0):
+        """Download a URL to a stream and return its (finished) reply."""
         itime = time.time()
-        while self._load_status is None:
-            if timeout and time.time() - itime > timeout:
-                raise SpynnerTimeout("Timeout reached: %d seconds" % timeout)
-            self._events_loop()
-        self._events_loop(0.0)
+        reply = self._get_download_reply(url, offset)
+        self._start_download(reply, outfd, progress, offset)
+        # The manager finished signal (see _on_reply) will wake us up
+        _wait_for(reply.isFinished)
+        reply.deleteLater()
+        if not reply.error():
+            self._count_download(reply.downloaded_nbytes, itime)
+        return reply
+
+    def _get_download_reply(self, url, offset=0):
+        if not urlparse.urlsplit(url).scheme:
+            url = urlparse.urljoin(self.url, url) 
+        request = QNetworkRequest(QUrl(url))
+        request.setAttribute(_download_attribute, QVariant(True))
+        if offset:
+            request.setRawHeader("Range", "bytes=%d-" % offset)
+        reply = self.manager.get(request)
+        if reply.error():
+            raise SpynnerError("Download error: %s" % reply.errorString())
+        return reply
+
+    def _wait_load(self, timeout=None):
+        try:
+            _wait_for(lambda: self._load_status is not None, timeout)
+        except SpynnerTimeout:
+            self.metrics.inc("timeouts_total")
+            raise
         if self._load_status:
-            jscode = "var %s = jQuery.noConflict();" % self.jslib
-            self.runjs(self.javascript + jscode, debug=False)
             self.webpage.setViewportSize(self.webpage.mainFrame().contentsSize())            
         load_status = self._load_status
         self._load_status = None
         return load_status        
 
-    def _debug(self, level, *args):
-        if level <= self.debug_level:
-            kwargs = dict(outfd=self.debug_stream)
-            _debug(*args, **kwargs)
+    def _debug_enabled(self, level):
+        return (level <= self.debug_level or 
+            _logger.isEnabledFor(_logging_levels[level]))
+
+    def _debug(self, level, msg, *args):
+        # Arguments are only formatted if the line is emitted
+        loglevel = _logging_levels[level]
+        if _logger.isEnabledFor(loglevel):
+            self.logger.log(loglevel, msg, *args)
+        elif level <= self.debug_level:
+            # Not enabled by the logging configuration, debug stream only
+            record = _logger.makeRecord(_logger.name, loglevel, 
+                "(unknown file)", 0, msg, args, None, 
+                extra={"spynner_browser": self})
+            _debug_handler.handle(record)
 
     def _user_agent_for_url(self, url):
         if self.user_agent:
             return self.user_agent
         return QWebPage.userAgentForUrl(self.webpage, url)
 
+    def _evaluate_javascript(self, target, jscode):
+        """Evaluate code on a frame (or element) and update the metrics."""
+        itime = time.time()
+        r = target.evaluateJavaScript(jscode)
+        self.metrics.inc("js_evaluations_total")
+        self.metrics.observe("js_evaluation_seconds", time.time() - itime)
+        return r
+
     def _runjs_on_jquery(self, name, code):
+        self.inject_jquery()
         code2 = "result = %s; result.length" % code
         if self.runjs(code2).toInt() < 1:
             raise SpynnerJavascriptError("error on %s: %s" % (name, code))
             
 
+    def _find_elements(self, selector):
+        return self.webframe.findAllElements(selector).toList()
+
+    def _get_element(self, selector):
+        element = self.query(selector)
+        if element is None:
+            raise SpynnerError("No element matches selector: %s" % selector)
+        return element
+
+    def _get_elements(self, selector):
+        elements = self._find_elements(selector)
+        if not elements:
+            raise SpynnerError("No element matches selector: %s" % selector)
+        return elements
+
+    def _run_on_elements(self, name, selector, jscode, jquery_jscode):
+        elements = self._find_elements(selector)
+        if not elements:
+            # Not a CSS selector (or nothing matched), let jQuery deal with it
+            self._runjs_on_jquery(name, jquery_jscode)
+            return
+        for element in elements:
+            self._evaluate_javascript(element, jscode)
+
+    def _render(self, image, x=0, y=0):
+        """Render the frame area at (x, y) with the size of image into it."""
+        painter = QPainter(image)
+        painter.translate(-x, -y)
+        self.webframe.render(painter, 
+            QRegion(x, y, image.width(), image.height()))
+        painter.end()
+
     def _get_html(self):
-        return unicode(self.webframe.toHtml())
+        # The DOM observer (see _dom_observer_jscode) calls the bridge on 
+        # changes only while it's not dirty, re-arm it before serializing.
+        if not self._html_cache or self._html_cache[0] != self._dom_version:
+            self._bridge.dom_dirty = False
+            html = unicode(self.webframe.toHtml())
+            self._html_cache = (self._dom_version, html)
+        return self._html_cache[1]
         #return str(self.webframe.toHtml().toAscii())
 
+    def _start_soup_prefetch(self):
+        def _parse():
+            try:
+                soup = parser(html)
+            except Exception:
+                # Parsed (and the error raised) again when the soup is requested
+                return
+            with self._soup_lock:
+                # A newer prefetch (or invalidate_soup) makes this one stale
+                if self._soup_thread is thread:
+                    self._soup_cache = (version, soup)
+        html = self.html
+        version = self._dom_version
+        parser = self._html_parser
+        thread = threading.Thread(target=_parse)
+        thread.daemon = True
+        with self._soup_lock:
+            self._soup_thread = thread
+        thread.start()
+
     def _get_soup(self):
         if not self._html_parser:
             raise SpynnerError("Cannot get soup with no HTML parser defined")
-        return self._html_parser(self.html)
+        if self._soup_thread:
+            self._soup_thread.join()
+            self._soup_thread = None
+        html = self.html
+        if not self._soup_cache or self._soup_cache[0] != self._dom_version:
+            self._soup_cache = (self._dom_version, self._html_parser(html))
+        return self._soup_cache[1]
 
     def _get_url(self):
         return unicode(self.webframe.url().toString())
@@ -347,15 +732,18 @@ class Browser:
     """Current URL."""        
                  
     html = property(_get_html)
-    """Rendered HTML in current page."""
+    """Rendered HTML in current page. The value is cached until the DOM
+    changes, so repeated reads of the same page are cheap."""
                  
     soup = property(_get_soup)
-    """HTML soup (see L{set_html_parser})."""
+    """HTML soup (see L{set_html_parser}). Like L{html}, it is cached
+    until the DOM changes."""
                
     #{ Basic interaction with browser
 
     def load(self, url):
         """Load a web page and return status (a boolean)."""
+        self._request_mark = self._requests_count
         self.webframe.load(QUrl(url))
         return self._wait_load()
 
@@ -365,10 +753,10 @@ class Browser:
         
         @param selector: jQuery selector.
         @param wait_load: If True, it will wait until a new page is loaded.
-        @param timeout: Seconds to wait for the page to load before 
-                                       raising an exception.
-        @param wait_requests: How many requests to wait before returning. Useful
-                              for AJAX requests.
+        @param timeout: Seconds to wait for the page to load (or the requests
+                        to finish) before raising an exception.
+        @param wait_requests: How many requests (started after the click) to 
+                              wait before returning. Useful for AJAX requests.
     
         By default this method will not wait for a page to load. 
         If you are clicking a link or submit button, you must call this
@@ -383,12 +771,10 @@ class Browser:
         L{download_directory}/I{server.org/dir1/dir2/file.ext}.                 
         """
         jscode = "%s('%s').simulate('click')" % (self.jslib, selector)
-        self._replies = 0
+        self._request_mark = self._requests_count
         self._runjs_on_jquery("click", jscode)
         if wait_requests:
-            while self._replies < wait_requests:
-                self._events_loop()
-            self._events_loop(0.0)
+            self.wait_requests(wait_requests, timeout=timeout)
         if wait_load:
             return self._wait_load(timeout)
 
@@ -410,19 +796,100 @@ class Browser:
         """
         return self._wait_load(timeout)
 
+    def wait_requests(self, count=1, match=None, timeout=None):
+        """
+        Wait until some requests started after the last L{load} or L{click} 
+        have finished.
+        
+        @param count: Number of requests to wait for.
+        @param match: Regular expression (string or compiled) that request 
+                      URLs must match to be counted (None: all requests).
+        @param timeout: Time to wait (seconds).
+        @raise SpynnerTimeout: If timeout is reached.
+        """
+        regexp = (re.compile(match) if isinstance(match, basestring) else match)
+        mark = self._request_mark
+        def _finished():
+            return sum(1 for record in self._finished_requests if 
+                record.seq > mark and (not regexp or regexp.search(record.url)))
+        _wait_for(lambda: _finished() >= count, timeout)
+
+    def wait_network_idle(self, idle_time=0.5, max_inflight=0, timeout=None):
+        """
+        Wait until the network is quiet.
+        
+        @param idle_time: Time (seconds) with no requests starting or 
+                          finishing and no more than C{max_inflight} 
+                          requests in flight.
+        @param max_inflight: Requests that may be still running (useful for
+                             pages that keep long-polling connections open).
+        @param timeout: Time to wait (seconds).
+        @raise SpynnerTimeout: If timeout is reached.
+        """
+        deadline = (time.time() + timeout if timeout else None)
+        def _remaining():
+            if deadline is None:
+                return None
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise SpynnerTimeout("Timeout reached: %s seconds" % timeout)
+            return remaining
+        while True:
+            _wait_for(lambda: len(self._inflight_requests) <= max_inflight, 
+                _remaining())
+            quiet_time = time.time() - self._last_network_activity
+            if quiet_time >= idle_time:
+                return
+            # Wait until the idle time is over or some request finishes
+            last_activity = self._last_network_activity
+            remaining = _remaining()
+            try:
+                _wait_for(lambda: self._last_network_activity != last_activity,
+                    min(idle_time - quiet_time, remaining or idle_time))
+            except SpynnerTimeout:
+                pass
+
+    def wait_for_selector(self, selector, timeout=None):
+        """
+        Wait until some element matches a CSS selector and return it.
+        
+        @param selector: CSS selector (see L{query}).
+        @param timeout: Time to wait (seconds).
+        @raise SpynnerTimeout: If timeout is reached.
+        
+        The page notifies the browser on every DOM mutation (through a
+        MutationObserver), so there is no polling involved.
+        """
+        self._wait_for_dom(lambda: self.query(selector) is not None, timeout)
+        return self.query(selector)
+
+    def wait_for_js(self, jscode, timeout=None):
+        """
+        Wait until a Javascript expression is true.
+        
+        @param jscode: Javascript expression.
+        @param timeout: Time to wait (seconds).
+        @raise SpynnerTimeout: If timeout is reached.
+        
+        The expression is evaluated again on every DOM mutation and 
+        finished network request.
+        """
+        jscode = "!!(%s)" % jscode
+        self._wait_for_dom(lambda: 
+            self._evaluate_javascript(self.webframe, jscode).toBool(), timeout)
+
     def wait(self, waittime):
         """
         Wait some time.
         
         @param waittime: Time to wait (seconds).
         
-        This is an active wait, the events loop will be run, so it
-        may be useful to wait for synchronous Javascript events that
-        change the DOM.
+        The events loop will be run, so it may be useful to wait for 
+        synchronous Javascript events that change the DOM.
         """   
-        itime = time.time()
-        while time.time() - itime < waittime:
-            self._events_loop()        
+        loop = QEventLoop()
+        QTimer.singleShot(int(waittime * 1000), loop.quit)
+        loop.exec_()
 
     def close(self):
         """Close Browser instance and release resources."""        
@@ -492,8 +959,7 @@ class Browser:
         if not self.webview:
             raise SpynnerError("Webview is not initialized")
         self.show()
-        while self.webview:
-            self._events_loop()
+        _wait_for(lambda: not self.webview)
 
     #}
                         
@@ -503,17 +969,18 @@ class Browser:
         """Fill an input text with a string value using a jQuery selector."""
         escaped_value = value.replace("'", "\\'")
         jscode = "%s('%s').val('%s')" % (self.jslib, selector, escaped_value)
-        self._runjs_on_jquery("fill", jscode)
+        self._run_on_elements("fill", selector, 
+            "this.value = %s" % json.dumps(value), jscode)
 
     def check(self, selector):
         """Check an input checkbox using a jQuery selector."""
         jscode = "%s('%s').attr('checked', true)" % (self.jslib, selector)
-        self._runjs_on_jquery("check", jscode)
+        self._run_on_elements("check", selector, "this.checked = true", jscode)
 
     def uncheck(self, selector):
         """Uncheck input checkbox using a jQuery selector"""
         jscode = "%s('%s').attr('checked', false)" % (self.jslib, selector)
-        self._runjs_on_jquery("uncheck", jscode)
+        self._run_on_elements("uncheck", selector, "this.checked = false", jscode)
 
     def choose(self, selector):        
         """Choose a radio input using a jQuery selector."""
@@ -523,11 +990,92 @@ class Browser:
     def select(self, selector):        
         """Choose a option in a select using a jQuery selector."""
         jscode = "%s('%s').attr('selected', 'selected')" % (self.jslib, selector)
-        self._runjs_on_jquery("select", jscode)
+        self._run_on_elements("select", selector, "this.selected = true", jscode)
     
     submit = click_link
+
+    def batch(self):
+        """
+        Return an L{ActionBatch} to queue form actions and run them in a 
+        single Javascript evaluation.
+        
+        >>> with browser.batch() as batch:
+        ...     batch.fill("input[name=user]", "me")
+        ...     batch.check("#remember")
+        >>> print batch.results
+        """
+        return ActionBatch(self)
+
+    def fill_form(self, values, check=(), uncheck=(), select=(), choose=()):
+        """
+        Fill a form in a single Javascript evaluation.
+        
+        @param values: Dictionary C{{selector: value}} of fields to L{fill}.
+        @param check: Selectors of checkboxes to L{check}.
+        @param uncheck: Selectors of checkboxes to L{uncheck}.
+        @param select: Selectors of options to L{select}.
+        @param choose: Selectors of radio inputs to L{choose}.
+        @return: Dictionary C{{selector: success}} (a boolean telling if
+                 the selector matched some element).
+        """
+        batch = ActionBatch(self)
+        for selector, value in values.iteritems():
+            batch.fill(selector, value)
+        for name, selectors in [("check", check), ("uncheck", uncheck),
+                                ("select", select), ("choose", choose)]:
+            for selector in selectors:
+                getattr(batch, name)(selector)
+        return dict((selector, ok) for (name, selector, ok) in batch.flush())
       
     #}
+
+    #{ Native element access
+    
+    def query(self, selector):
+        """
+        Return the first element matching a CSS selector (None if not found).
+        
+        @return: A PyQt4.QtWebKit.QWebElement object. 
+        
+        Elements are looked up with the native WebKit selector engine, no 
+        Javascript is evaluated. jQuery extensions (C{:first}, ...) are 
+        not supported by this family of methods.
+        """
+        element = self.webframe.findFirstElement(selector)
+        return (None if element.isNull() else element)
+
+    def query_all(self, selector):
+        """Return the list of elements (QWebElement) matching a CSS selector."""
+        return self._find_elements(selector)
+
+    def get_attribute(self, selector, name):
+        """Return an attribute of the first element matching a CSS selector."""
+        element = self._get_element(selector)
+        if not element.hasAttribute(name):
+            return None
+        return unicode(element.attribute(name))
+
+    def get_text(self, selector):
+        """Return the text of the first element matching a CSS selector."""
+        return unicode(self._get_element(selector).toPlainText())
+
+    def set_value(self, selector, value):
+        """Set the value of all the form fields matching a CSS selector."""
+        jscode = "this.value = %s" % json.dumps(value)
+        for element in self._get_elements(selector):
+            self._evaluate_javascript(element, jscode)
+
+    def evaluate_on(self, selector, jscode):
+        """
+        Evaluate Javascript code on the elements matching a CSS selector.
+        
+        The element is available as C{this} in the code. Return the list of 
+        results (QVariant objects).
+        """
+        return [self._evaluate_javascript(element, jscode) 
+            for element in self._get_elements(selector)]
+
+    #}
     
     #{ Javascript 
     
@@ -546,12 +1094,78 @@ class Browser:
         @note: You can change the _jQuery alias (see L{jslib}).        
         """
         if debug:
-            self._debug(DEBUG, "Run Javascript code: %s" % jscode)        
-        r = self.webpage.mainFrame().evaluateJavaScript(jscode)
+            self._debug(DEBUG, "Run Javascript code: %s", jscode)        
+        r = self._evaluate_javascript(self.webpage.mainFrame(), jscode)
         if not r.isValid():
-            r = self.webpage.mainFrame().evaluateJavaScript(jscode)
+            r = self._evaluate_javascript(self.webpage.mainFrame(), jscode)
+        self._on_dom_changed()
         return r
 
+    def evaluate(self, jscode):
+        """
+        Evaluate Javascript code and return its result as a Python object.
+        
+        @param jscode: Javascript code (evaluated once, in the global scope).
+        @return: Result decoded from JSON (None for undefined values).
+        @raise SpynnerJavascriptError: If the code raises an exception.
+        
+        Unlike L{runjs}, the result is serialized in the page with 
+        C{JSON.stringify} and decoded in one pass, so it must be 
+        JSON-serializable (DOM nodes are not).
+        """
+        self._debug(DEBUG, "Evaluate Javascript code: %s", jscode)        
+        wrapper = "(function() { try { return JSON.stringify(" + \
+            "{value: (0, eval)(%s)}); } catch (e) { " % json.dumps(jscode) + \
+            "return JSON.stringify({error: String(e)}); } })()"
+        r = self._evaluate_javascript(self.webframe, wrapper)
+        self._on_dom_changed()
+        result = json.loads(unicode(r.toString()) or "{}")
+        if "error" in result:
+            raise SpynnerJavascriptError("error on evaluate: %s (%s)" % 
+                (jscode, result["error"]))
+        return result.get("value")
+
+    runjs_json = evaluate
+
+    def extract(self, spec):
+        """
+        Extract data from many elements in a single Javascript evaluation.
+        
+        @param spec: Dictionary C{{key: selector}} or 
+                     C{{key: (selector, attribute)}}. Selectors are CSS 
+                     selectors; attribute may be C{"text"} (default), 
+                     C{"html"} or the name of an element attribute.
+        @return: Dictionary C{{key: list of values}}.
+        
+        >>> browser.extract({"links": ("a", "href"), "titles": "h2"})
+        """
+        spec = dict((key, (value if isinstance(value, (tuple, list)) 
+            else (value, "text"))) for (key, value) in spec.iteritems())
+        jscode = """(function(spec) {
+          var result = {};
+          for (var key in spec) {
+            var elements = document.querySelectorAll(spec[key][0]);
+            var attr = spec[key][1], values = [];
+            for (var i = 0; i < elements.length; i++) {
+              var e = elements[i];
+              values.push(attr == "text" ? e.textContent : 
+                attr == "html" ? e.innerHTML : e.getAttribute(attr));
+            }
+            result[key] = values;
+          }
+          return result;
+        })(%s)""" % json.dumps(spec)
+        return self.evaluate(jscode)
+
+    def inject_jquery(self):
+        """
+        Inject jQuery into the main frame if it's not already there.
+        
+        Only needed when L{lazy_jquery} is enabled.
+        """
+        if not self._jquery_injected:
+            self._inject_jquery(self.webframe)
+
     def set_javascript_confirm_callback(self, callback):
         """
         Set function callback for Javascript confirm pop-ups.
@@ -599,44 +1213,284 @@ class Browser:
         """Set cookies from a string with Mozilla-format cookies.""" 
         return self.cookiesjar.setMozillaCookies(string_cookies)
 
+    def set_cookie_jar(self, cookiesjar):
+        """
+        Use a given cookie jar for all requests of this browser.
+        
+        The same jar can be set to many browsers to share their cookies.
+        """ 
+        self.cookiesjar = cookiesjar
+        self.manager.setCookieJar(cookiesjar)
+        # The manager takes ownership of the jar, give it back so other
+        # managers can use it too.
+        cookiesjar.setParent(None)
+
+    #}
+
+    #{ Sessions
+
+    def save_session(self, path):
+        """
+        Save the browser session to a file.
+        
+        The session includes cookies, the localStorage and sessionStorage 
+        of the current page, its URL and the HTTP credentials used so far. 
+        Use L{load_session} to resume the session in another browser.
+        
+        The file contains passwords and session cookies in clear, so it is 
+        created readable only by its owner (on POSIX systems).
+        """
+        storage = {}
+        origin = _get_url_origin(self.webframe.url())
+        if origin:
+            storage[origin] = self.evaluate(_dump_storage_jscode)
+        session = {
+            "url": self.url,
+            "cookies": map(_cookie_row_to_json, self.cookiesjar.cookieRows()),
+            "storage": storage,
+            "http_credentials": [list(key) + list(credentials) for key, 
+                credentials in self._http_credentials.iteritems()],
+        }
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        if hasattr(os, "fchmod"):
+            # O_CREAT does not change the mode of an existing file
+            os.fchmod(fd, 0600)
+        with os.fdopen(fd, "wb") as fileobj:
+            fileobj.write(_session_magic + json.dumps(session))
+
+    def load_session(self, path, load=True):
+        """
+        Restore a browser session saved with L{save_session}.
+        
+        @param path: Session file path.
+        @param load: If True, load the URL of the session (and return the 
+                     load status).
+        @raise SpynnerError: If the file is not a session file.
+        
+        Cookies are replaced by those of the session. The storage is 
+        restored when a page of its origin is loaded.
+        """
+        with open(path, "rb") as fd:
+            data = fd.read()
+        if not data.startswith(_session_magic):
+            raise SpynnerError("Not a session file: %s" % path)
+        try:
+            session = json.loads(data[len(_session_magic):])
+            cookies = map(_cookie_row_from_json, session["cookies"])
+            credentials = dict(((host, realm), (user, password)) for 
+                host, realm, user, password in session["http_credentials"])
+        except (ValueError, TypeError, KeyError):
+            raise SpynnerError("Corrupted session file: %s" % path)
+        self.cookiesjar.setCookieRows(cookies)
+        self._pending_storage.update(session["storage"])
+        self._http_credentials.update(credentials)
+        if load and session["url"]:
+            return self.load(session["url"])
+
     #}
     
     #{ Download files
                 
-    def download(self, url, outfd=None):
+    def download(self, url, outfd=None, progress=None, offset=0):
         """
         Download a given URL using current cookies.
         
         @param url: URL or path to download
         @param outfd: Output file-like stream. If None, return data string.
+        @param progress: Function C{progress(nbytes, total, rate)} called 
+                         when data is received. C{total} is None if
+                         the size is unknown, C{rate} is in bytes/second.
+        @param offset: Start downloading at this byte (a Range request is
+                       sent; if the server ignores it, the data before the 
+                       offset is discarded).
         @return: Bytes downloaded (None if something went wrong)
         @note: If url is a path, the current base URL will be pre-appended.        
+        
+        Downloads use the same network manager than pages, so connections 
+        to the server (and the cache, if enabled) are reused. Data is 
+        streamed to C{outfd} in chunks of L{download_chunk_size} bytes.
         """
-        def _on_reply(reply):
-            url = unicode(reply.url().toString())
-            self._download_reply_status = not bool(reply.error())
-        self._download_reply_status = None
-        if not urlparse.urlsplit(url).scheme:
-            url = urlparse.urljoin(self.url, url) 
-        request = QNetworkRequest(QUrl(url))
-        # Create a new manager to process this download        
-        manager = QNetworkAccessManager()
-        reply = manager.get(request)
-        if reply.error():
-            raise SpynnerError("Download error: %s" % reply.errorString())
-        reply.downloaded_nbytes = 0
-        manager.setCookieJar(self.manager.cookieJar())
-        manager.connect(manager, SIGNAL('finished(QNetworkReply *)'), _on_reply)
         outfd_set = bool(outfd)
         if not outfd_set:
             outfd = StringIO()            
-        self._start_download(reply, outfd)
-        while self._download_reply_status is None:
-            self._events_loop()
+        reply = self._download(url, outfd, progress, offset)
         if outfd_set:
             return (reply.downloaded_nbytes if not reply.error() else None)
         else:
             return outfd.getvalue()  
+
+    def download_file(self, url, path=None, resume=True, progress=None):
+        """
+        Download a given URL to a file.
+        
+        @param url: URL or path to download
+        @param path: Output file path (by default, a path in 
+                     L{download_directory}, see L{click}).
+        @param resume: If True and the file exists, resume the download.
+        @param progress: Progress callback (see L{download}).
+        @return: Bytes downloaded, the size of the file if it was already 
+                 complete, or None if something went wrong (the file is 
+                 then left as it was before the call).
+        """
+        if path is None:
+            path = self._get_filepath_for_url(self.get_url_from_path(url))
+        offset = (os.path.getsize(path) if resume and os.path.exists(path) else 0)
+        outfd = open(path, ("ab" if offset else "wb"))
+        try:
+            reply = self._download(url, outfd, progress, offset)
+        finally:
+            outfd.close()
+        if not reply.error():
+            return reply.downloaded_nbytes
+        if offset and _is_download_complete(reply, offset):
+            return offset
+        # Do not leave partial data, a resume would append to it
+        if offset:
+            with open(path, "r+b") as fd:
+                fd.truncate(offset)
+        else:
+            os.remove(path)
+        return None
+            
+    def iter_download(self, url, chunk_size=None, offset=0):
+        """
+        Download a given URL and yield its data in chunks.
+        
+        @param url: URL or path to download
+        @param chunk_size: Maximum size of chunks (by default 
+                           L{download_chunk_size}).
+        @param offset: Start downloading at this byte (see L{download}).
+        @raise SpynnerError: If the download fails.
+        
+        Data is only read from the network when the caller asks for more 
+        chunks, so memory usage is bounded whatever the size of the file.
+        """
+        chunk_size = chunk_size or self.download_chunk_size
+        itime = time.time()
+        reply = self._get_download_reply(url, offset)
+        reply.setReadBufferSize(4 * chunk_size)
+        reply.connect(reply, SIGNAL("readyRead()"), _wake_up)
+        skip, nbytes = None, 0
+        try:
+            while True:
+                _wait_for(lambda: reply.bytesAvailable() > 0 or reply.isFinished())
+                if reply.bytesAvailable() <= 0:
+                    break
+                if skip is None:
+                    status = _get_http_status(reply)
+                    if status >= 400:
+                        raise SpynnerError("Download error: HTTP status %d" % status)
+                    skip = _get_download_skip(reply, offset)
+                data = reply.read(chunk_size)
+                if skip:
+                    nskip = min(len(data), skip)
+                    data = data[nskip:]
+                    skip -= nskip
+                if data:
+                    nbytes += len(data)
+                    yield data
+            if reply.error():
+                raise SpynnerError("Download error: %s" % reply.errorString())
+            self._count_download(nbytes, itime)
+        finally:
+            if not reply.isFinished():
+                reply.abort()
+            reply.deleteLater()
+
+    def idownload_many(self, urls, max_concurrency=8, per_host=4, 
+                       outfds=None, callback=None):
+        """
+        Download many URLs concurrently, yield a L{DownloadResult} as soon as 
+        each download finishes.
+        
+        @param urls: Iterable of URLs (or paths, see L{download}). Repeated
+                     URLs are downloaded only once.
+        @param max_concurrency: Maximum number of simultaneous downloads.
+        @param per_host: Maximum number of simultaneous downloads from the 
+                         same host (None for no limit).
+        @param outfds: Dictionary C{{url: file-like stream}} where data
+                       is written. 
+        @param callback: Function C{callback(url, data)} called for every
+                         chunk of data received.
+        
+        Data of URLs with no output stream nor callback is saved to 
+        L{download_directory} (see L{click}). All downloads share the 
+        cookies and the connections of the browser.
+        @raise ValueError: If C{max_concurrency} or C{per_host} are not 
+                           positive.
+        """
+        if max_concurrency <= 0:
+            raise ValueError("max_concurrency must be positive: %r" % max_concurrency)
+        if per_host is not None and per_host <= 0:
+            raise ValueError("per_host must be positive: %r" % per_host)
+        pending, seen = [], set()
+        for url in urls:
+            if url not in seen:
+                seen.add(url)
+                pending.append((url, self.get_url_from_path(url)))
+        return self._idownload_many(pending, max_concurrency, per_host, 
+            outfds, callback)
+
+    def _idownload_many(self, pending, max_concurrency, per_host, outfds, 
+                        callback):
+        active = {}
+        hosts = collections.defaultdict(int)
+        try:
+            while pending or active:
+                for url, absurl in list(pending):
+                    if len(active) >= max_concurrency:
+                        break
+                    host = urlparse.urlsplit(absurl).netloc
+                    if per_host is not None and hosts[host] >= per_host:
+                        continue
+                    pending.remove((url, absurl))
+                    try:
+                        reply = self._get_download_reply(absurl)
+                    except SpynnerError, exc:
+                        yield DownloadResult(url, False, error=str(exc))
+                        continue
+                    if callback:
+                        outfd, close = _CallbackWriter(callback, url), False
+                    elif outfds and url in outfds:
+                        outfd, close = outfds[url], False
+                    else:
+                        outfd, close = open(self._get_filepath_for_url(absurl), "wb"), True
+                    self._start_download(reply, outfd)
+                    active[reply] = (url, host, outfd, close, time.time())
+                    hosts[host] += 1
+                if active:
+                    _wait_for(lambda: any(reply.isFinished() for reply in active))
+                for reply in [reply for reply in active if reply.isFinished()]:
+                    url, host, outfd, close, itime = active.pop(reply)
+                    hosts[host] -= 1
+                    if close:
+                        outfd.close()
+                    status = not reply.error()
+                    if status:
+                        self._count_download(reply.downloaded_nbytes, itime)
+                    result = DownloadResult(url, status, reply.downloaded_nbytes, 
+                        time.time() - itime, 
+                        error=(None if status else unicode(reply.errorString())),
+                        path=(outfd.name if close else None))
+                    reply.deleteLater()
+                    yield result
+        finally:
+            for reply, (url, host, outfd, close, itime) in active.items():
+                reply.abort()
+                if close:
+                    outfd.close()
+        
+    def download_many(self, urls, max_concurrency=8, per_host=4, 
+                      outfds=None, callback=None):
+        """
+        Download many URLs concurrently and return a list of L{DownloadResult} 
+        (in the same order than C{urls}, a repeated URL gets the result of its
+        only download). See L{idownload_many} for details.
+        """
+        urls = list(urls)
+        results = dict((result.url, result) for result in self.idownload_many(urls, 
+            max_concurrency, per_host, outfds, callback))
+        return [results[url] for url in urls]
     
     #}
             
@@ -652,6 +1506,20 @@ class Browser:
         the parsed HTML.        
         """
         self._html_parser = parser
+        self.invalidate_soup()
+
+    def invalidate_soup(self):
+        """
+        Discard the cached L{soup}. 
+        
+        Useful if the soup object has been modified by the caller (for 
+        example, with pyquery's C{make_links_absolute}).
+        """
+        if self._soup_thread:
+            self._soup_thread.join()
+        with self._soup_lock:
+            self._soup_thread = None
+            self._soup_cache = None
 
     def html_contains(self, regexp):
         """Return True if current HTML contains a given regular expression."""
@@ -679,6 +1547,69 @@ class Browser:
     
     #}
              
+    #{ Network cache
+
+    def enable_cache(self, directory, max_size=50*1024*1024, force_static=False):
+        """
+        Enable a persistent HTTP cache.
+        
+        @param directory: Directory where the cache is stored.
+        @param max_size: Size budget (bytes). When exceeded, least recently 
+                         used entries are evicted.
+        @param force_static: If True, static assets (stylesheets, scripts, 
+                             images and fonts) are taken from the cache when
+                             available, with no expiration check.
+        
+        Cache-Control, Expires, ETag and Last-Modified headers are honoured.
+        Hits and misses are counted in L{cache_hits} and L{cache_misses}.
+        """
+        self.cache = _LRUDiskCache()
+        self.cache.setCacheDirectory(directory)
+        self.cache.setMaximumCacheSize(max_size)
+        self.manager.setCache(self.cache)
+        self._cache_static_assets = force_static
+        
+    #}
+
+    #{ Network requests
+
+    def export_har(self, path=None, requests=None):
+        """
+        Export network requests in HAR 1.2 format.
+        
+        @param path: If given, the HAR JSON is written to this file.
+        @param requests: L{RequestRecord} objects to export (default: 
+                         L{requests}, those of the current page).
+        @return: HAR data as a dictionary.
+        @raise SpynnerError: If no requests are given and L{record_requests}
+                             is not enabled.
+        """
+        if requests is None:
+            if not self.record_requests:
+                raise SpynnerError("Requests are not recorded (see record_requests)")
+            requests = self.requests
+        started, finished = self._page_load_times
+        page = {
+            "id": "page_1",
+            "title": unicode(self.webframe.title()),
+            "startedDateTime": _har_datetime(started or time.time()),
+            "pageTimings": {"onContentLoad": -1, "onLoad": 
+                _har_milliseconds(started, finished)},
+        }
+        har = {"log": {
+            "version": "1.2",
+            "creator": {"name": "spynner", "version": ""},
+            "browser": {"name": "QtWebKit", "version": str(qWebKitVersion())},
+            "pages": [page],
+            "entries": [_har_entry(record, page["id"]) for record in requests],
+        }}
+        if path:
+            with open(path, "w") as fd:
+                json.dump(har, fd, indent=2)
+        return har
+
+    #}
+
     #{ Miscellaneous
     
     def snapshot(self, box=None, format=QImage.Format_ARGB32):
@@ -694,21 +1625,122 @@ class Browser:
         
         >>> browser.load(url)
         >>> browser.snapshot().save("webpage.png") 
+        
+        Only the box area is rendered and allocated. For huge pages, see 
+        L{snapshot_tiles}.
         """
         if box:
             x1, y1, x2, y2 = box        
-            w, h = (x2 - x1), (y2 - y1)
-            image0 = QImage(QSize(x2, y2), format)
-            painter = QPainter(image0)
-            self.webpage.mainFrame().render(painter)
-            painter.end()
-            image = image0.copy(x1, y1, w, h)
+            image = QImage(QSize(x2 - x1, y2 - y1), format)
+            self._render(image, x1, y1)
         else:
             image = QImage(self.webpage.viewportSize(), format)
-            painter = QPainter(image)                        
-            self.webpage.mainFrame().render(painter)
-            painter.end()
+            self._render(image)
         return image
+
+    def snapshot_async(self, path, format=None, quality=-1, box=None, 
+                       callback=None):
+        """
+        Take an image snapshot and save it to a file in background.
+        
+        @param path: Output file path.
+        @param format: Image format (by default, guessed from the path).
+        @param quality: Compression quality (0-100, -1 for the default).
+        @param box: Box to capture (see L{snapshot}).
+        @param callback: Function C{callback(path, success)} called when 
+                         the file has been written.
+        
+        The page is rendered in the calling thread, encoding and writing 
+        are done by a pool of L{snapshot_threads} threads, shared by all 
+        browsers in the process. If there are L{snapshot_queue_size} 
+        snapshots pending, the call waits (running the event loop) until 
+        one is done. Callbacks are called from the event loop.
+        """
+        writer = _get_image_writer(self.snapshot_threads, self.snapshot_queue_size)
+        writer.put(self.snapshot(box), path, format, quality, callback)
+
+    def wait_snapshots(self, timeout=None):
+        """
+        Wait until all the snapshots taken with L{snapshot_async} are saved.
+        
+        @raise SpynnerTimeout: If timeout (seconds) is reached.
+        """
+        writer = _get_image_writer(self.snapshot_threads, self.snapshot_queue_size)
+        _wait_for(lambda: not writer.pending, timeout)
+
+    def snapshot_tiles(self, callback=None, tile_size=(1024, 1024), path=None,
+                       format=QImage.Format_ARGB32):
+        """
+        Take a snapshot of the whole page in tiles. 
+        
+        @param callback: Function C{callback(image, x, y)} called for every
+                         tile (a QImage) with its position in the page.
+        @param tile_size: 2-element tuple with the size of tiles 
+                          (width, height). Tiles in the right and bottom
+                          edges may be smaller.
+        @param path: Path template to save tiles, using C{%(x)d} and 
+                     C{%(y)d} for the tile position 
+                     (e.g. C{"page-%(y)06d-%(x)06d.png"}).
+        @param format: QImage format (see QImage::Format_*).
+        @return: Number of tiles.
+        
+        Tiles are rendered one at a time into the same image, so memory 
+        usage is bounded by the tile size (copy the image in the callback
+        if you need to keep it).
+        """
+        size = self.webframe.contentsSize()
+        tile_width, tile_height = tile_size
+        image = None
+        ntiles = 0
+        for y in range(0, size.height(), tile_height):
+            for x in range(0, size.width(), tile_width):
+                width = min(tile_width, size.width() - x)
+                height = min(tile_height, size.height() - y)
+                if not image or (image.width(), image.height()) != (width, height):
+                    image = QImage(QSize(width, height), format)
+                self._render(image, x, y)
+                if callback:
+                    callback(image, x, y)
+                if path:
+                    image.save(path % dict(x=x, y=y))
+                ntiles += 1
+        return ntiles
+
+    def snapshot_array(self, box=None, reuse=True):
+        """
+        Take a snapshot of the current frame into a NumPy array.
+        
+        @param box: 4-element tuple containing box to capture (x1, y1, x2, y2).
+                    If None, capture the whole page.
+        @param reuse: If True, the array of the previous call is reused 
+                      (and overwritten) when the snapshot size is the same.
+        @return: A C{numpy.uint8} array with shape (height, width, 4).
+        
+        The page is rendered directly into the array memory (no copies).
+        Pixels are in QImage.Format_ARGB32 layout, which means bytes are 
+        ordered B, G, R, A on little-endian machines. NumPy is required. 
+        """
+        try:
+            import numpy
+        except ImportError:
+            raise SpynnerError("NumPy is required to take snapshots as arrays")
+        if box:
+            x1, y1, x2, y2 = box        
+            width, height = (x2 - x1), (y2 - y1)
+        else:
+            x1 = y1 = 0
+            size = self.webpage.viewportSize()
+            width, height = size.width(), size.height()
+        array = self._snapshot_array
+        if not reuse or array is None or array.shape[:2] != (height, width):
+            array = numpy.empty((height, width, 4), numpy.uint8)
+            if reuse:
+                self._snapshot_array = array
+        array.fill(0)
+        image = QImage(sip.voidptr(array.ctypes.data), width, height, 
+            width * 4, QImage.Format_ARGB32)
+        self._render(image, x1, y1)
+        return array
             
     def get_url_from_path(self, path):
         """Return the URL for a given path using the current URL as base."""
@@ -730,9 +1762,67 @@ class Browser:
             - C{url}: requested item URL.
             
         It should return C{True} (proceed) or C{False} (reject).
+        
+        See L{set_url_rules} for a faster way to block URLs.
         """
         self._url_filter = url_filter
 
+    def set_resource_policy(self, block=()):
+        """
+        Block some types of resources requested by pages.
+        
+        @param block: Iterable of resource types to block: C{"image"}, 
+                      C{"font"}, C{"media"}, C{"stylesheet"} or C{"script"}.
+                      An empty iterable removes the current policy.
+        
+        Requests are classified by their Accept header and extension, and
+        replies by their Content-Type (to abort them as soon as the headers 
+        arrive). When images are blocked, automatic image loading is also 
+        disabled in the page settings (and plugins when media is blocked).
+        
+        Statistics for the current page are kept in L{resource_stats}:
+        
+            - C{blocked_requests}: Requests never sent. It includes the 
+              images of C{<img>} elements skipped by the page settings, 
+              counted when the page is loaded (other images, as CSS 
+              backgrounds, are not counted).
+            - C{aborted_requests}: Replies aborted when their Content-Type 
+              was received.
+            - C{aborted_bytes}: Bytes not downloaded because of aborted 
+              replies (only for those with a Content-Length). The size of 
+              requests never sent is unknown.
+        """
+        block = set(block)
+        unknown = block - set(_resource_types)
+        if unknown:
+            raise SpynnerError("Unknown resource types: %s" % ", ".join(unknown))
+        self._blocked_resources = block
+        settings = self.webpage.settings()
+        settings.setAttribute(QWebSettings.AutoLoadImages, "image" not in block)
+        settings.setAttribute(QWebSettings.PluginsEnabled, "media" not in block)
+
+    def set_url_rules(self, rules):
+        """
+        Set rules to block URLs requested by pages.
+        
+        @param rules: Iterable of rules (None to remove the current rules):
+        
+            - Domain (C{ads.example.com}): block the domain and its 
+              subdomains.
+            - Compiled regular expression or C{/regexp/} string: block URLs 
+              matching it.
+            - Adblock Plus filter (C{||example.com^}, C{|http://ads.}, 
+              C{/banner/*/img^}, exceptions C{@@...}, comments C{!...}). 
+              Filters with options (C{$...}) and element hiding rules 
+              are ignored.
+            
+        Domains are stored in a hash index and patterns are indexed by a 
+        keyword (a literal token of the pattern), so only a few of them are
+        checked for each URL, even with big blocklists. Blocked requests 
+        fail immediately, no request is sent. 
+        """
+        self._url_rules = (_UrlRules(rules) if rules is not None else None)
+
     #}
 
 def _first(iterable, pred=bool):
@@ -741,6 +1831,252 @@ def _first(iterable, pred=bool):
         if pred(item):
             return item
 
+_static_extensions = set([".css", ".js", ".png", ".jpg", ".jpeg", ".gif", 
+    ".ico", ".svg", ".bmp", ".webp", ".woff", ".ttf", ".otf", ".eot"])
+
+def _is_static_asset(url):
+    """Return True if URL looks like a static asset (by its extension)."""
+    path = urlparse.urlsplit(url).path
+    return os.path.splitext(path)[1].lower() in _static_extensions
+
+_resource_types = {
+    "image": ([".png", ".jpg", ".jpeg", ".gif", ".ico", ".svg", ".bmp", ".webp"],
+              ["image/"]),
+    "font": ([".woff", ".woff2", ".ttf", ".otf", ".eot"],
+             ["font/", "application/font", "application/x-font", 
+              "application/vnd.ms-fontobject"]),
+    "media": ([".mp3", ".mp4", ".ogg", ".ogv", ".webm", ".wav", ".avi", 
+               ".flv", ".swf"],
+              ["audio/", "video/", "application/x-shockwave-flash"]),
+    "stylesheet": ([".css"], ["text/css"]),
+    "script": ([".js"], ["application/javascript", "application/x-javascript",
+                         "text/javascript"]),
+}
+
+def _get_resource_stats():
+    """Return empty resource policy statistics."""
+    return dict(blocked_requests=0, aborted_requests=0, aborted_bytes=0)
+
+_resource_profiles = {
+    "fast": ("image", "font", "media", "stylesheet"),
+}
+
+def _get_content_type_resource_type(content_type):
+    """Return the resource type for a Content-Type (None if unknown)."""
+    content_type = content_type.lower()
+    for resource, (extensions, content_types) in _resource_types.iteritems():
+        if any(content_type.startswith(ct) for ct in content_types):
+            return resource
+
+def _get_request_resource_type(request, url):
+    """Return the resource type of a request (None if unknown)."""
+    accept = str(request.rawHeader("Accept")).lower()
+    if accept.startswith("image/"):
+        return "image"
+    if accept.startswith("text/css"):
+        return "stylesheet"
+    extension = os.path.splitext(urlparse.urlsplit(url).path)[1].lower()
+    for resource, (extensions, content_types) in _resource_types.iteritems():
+        if extension in extensions:
+            return resource
+
+_download_attribute = QNetworkRequest.Attribute(QNetworkRequest.User + 1)
+
+def _get_http_status(reply):
+    """Return the HTTP status code of a reply (0 if unknown)."""
+    status, ok = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute).toInt()
+    return (status if ok else 0)
+
+def _is_download_complete(reply, offset):
+    """Return True if a Range request failed because the file is complete."""
+    if _get_http_status(reply) != 416:
+        return False
+    # Content-Range: bytes */<complete length> (if the server sends it)
+    content_range = str(reply.rawHeader("Content-Range"))
+    return (not content_range or content_range == "bytes */%d" % offset)
+
+def _get_download_skip(reply, offset):
+    """Return the bytes to discard from a reply requested with a Range."""
+    # The server may ignore the Range header and send the whole file
+    return (offset if offset and _get_http_status(reply) != 206 else 0)
+
+def _get_download_total(reply, offset):
+    """Return the total size of a download (None if unknown)."""
+    length, ok = reply.header(QNetworkRequest.ContentLengthHeader).toLongLong()
+    if not ok:
+        return
+    status, ok = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute).toInt()
+    return (length + offset if status == 206 else length)
+
+# Notify the bridge (once until Python re-arms it) on every DOM change 
+_dom_observer_jscode = """(function(bridge) {
+  var notify = function() { if (!bridge.domDirty) bridge.domChanged(); };
+  var Observer = window.MutationObserver || window.WebKitMutationObserver;
+  if (Observer) 
+    new Observer(notify).observe(document, {childList: true, subtree: true, 
+      attributes: true, characterData: true});
+  else
+    document.addEventListener("DOMSubtreeModified", notify, false);
+})(_spynner);"""
+
+_javascript_sources = {}
+
+def _get_javascript(directories, filenames):
+    """Return the concatenated source of Javascript files (read only once)."""
+    key = (tuple(directories), tuple(filenames))
+    if key not in _javascript_sources:
+        directory = _first(directories, os.path.isdir)
+        if not directory:
+            raise SpynnerError("Cannot find javascript directory: %s" %
+                directories)           
+        _javascript_sources[key] = "".join(open(os.path.join(directory, fn)).read() 
+            for fn in filenames)
+    return _javascript_sources[key]
+
+_application = None
+
+def _get_application(qappargs=None):
+    """Return the QApplication of the process (create it if necessary)."""
+    global _application
+    if _application is None:
+        _application = QApplication.instance() or QApplication(qappargs or [])
+    return _application
+
+def _get_request_initiator(request):
+    """Return the URL of the frame that made a request (None if unknown)."""
+    origin = request.originatingObject()
+    if isinstance(origin, QWebFrame):
+        return unicode(origin.url().toString())
+
+def _har_datetime(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).isoformat() + "Z"
+
+def _har_milliseconds(start, end):
+    if start is None or end is None:
+        return -1
+    return int(round((end - start) * 1000))
+
+def _har_entry(record, pageref):
+    """Return the HAR entry (a dictionary) of a L{RequestRecord}."""
+    headers = lambda pairs: [dict(name=n, value=v) for (n, v) in pairs]
+    query = urlparse.parse_qsl(urlparse.urlsplit(record.url).query, True)
+    response_headers = dict((n.lower(), v) for (n, v) in record.response_headers)
+    end = record.finished
+    wait = _har_milliseconds(record.started, record.first_byte or end)
+    receive = (_har_milliseconds(record.first_byte, end) 
+        if record.first_byte else 0)
+    return {
+        "pageref": pageref,
+        "startedDateTime": _har_datetime(record.started),
+        "time": max(0, _har_milliseconds(record.started, end)),
+        "request": {
+            "method": record.operation.upper(),
+            "url": record.url,
+            "httpVersion": "HTTP/1.1",
+            "cookies": [],
+            "headers": headers(record.request_headers),
+            "queryString": headers(query),
+            "headersSize": -1,
+            "bodySize": record.request_size,
+        },
+        "response": {
+            "status": record.status or 0,
+            "statusText": record.status_text,
+            "httpVersion": "HTTP/1.1",
+            "cookies": [],
+            "headers": headers(record.response_headers),
+            "content": {"size": record.size, "mimeType": record.content_type},
+            "redirectURL": response_headers.get("location", ""),
+            "headersSize": -1,
+            "bodySize": record.size,
+        },
+        "cache": {},
+        "timings": {"send": 0, "wait": max(0, wait), "receive": max(0, receive)},
+        "_initiator": record.initiator,
+        "_fromCache": record.from_cache,
+        "_error": record.error,
+    }
+
+_session_magic = "SPYNNER-SESSION-2\n"
+
+_dump_storage_jscode = """(function() {
+  var names = {local: "localStorage", session: "sessionStorage"}, r = {};
+  for (var kind in names) {
+    r[kind] = {};
+    try {
+      var storage = window[names[kind]];
+      for (var i = 0; storage && i < storage.length; i++)
+        r[kind][storage.key(i)] = storage.getItem(storage.key(i));
+    } catch (e) {}
+  }
+  return r;
+})()"""
+
+_restore_storage_jscode = """(function(data) {
+  var names = {local: "localStorage", session: "sessionStorage"};
+  for (var kind in names) {
+    try {
+      var storage = window[names[kind]];
+      for (var key in data[kind])
+        storage.setItem(key, data[kind][key]);
+    } catch (e) {}
+  }
+})(%s);"""
+
+def _get_url_origin(qurl):
+    """Return the origin (scheme://host[:port]) of a QUrl (None if empty)."""
+    if qurl.isEmpty() or not qurl.host():
+        return
+    origin = u"%s://%s" % (unicode(qurl.scheme()), unicode(qurl.host()))
+    if qurl.port() != -1:
+        origin += u":%d" % qurl.port()
+    return origin
+
+_image_writer = None
+
+def _get_image_writer(nthreads, max_pending):
+    """Return the L{_ImageWriter} of the process (create it if necessary)."""
+    global _image_writer
+    if _image_writer is None:
+        _image_writer = _ImageWriter(nthreads, max_pending)
+    return _image_writer
+
+_waiting_loops = []
+
+def _wait_for(condition, timeout=None):
+    """
+    Run a nested event loop until condition() is true.
+    
+    The loop blocks until Qt has some event to process, so there is no
+    polling involved; handlers that change the state a wait may depend on
+    must call L{_wake_up} to make the condition be checked again. 
+    Raise SpynnerTimeout if timeout (seconds) is reached first.
+    """
+    if condition():
+        return
+    loop = QEventLoop()
+    timer = None
+    if timeout:
+        timer = QTimer()
+        timer.setSingleShot(True)
+        timer.connect(timer, SIGNAL("timeout()"), loop.quit)
+        timer.start(int(timeout * 1000))
+    _waiting_loops.append(loop)
+    try:
+        while not condition():
+            if timer and not timer.isActive():
+                raise SpynnerTimeout("Timeout reached: %s seconds" % timeout)
+            loop.exec_()
+    finally:
+        _waiting_loops.remove(loop)
+        if timer:
+            timer.stop()
+
+def _wake_up():
+    """Make all the running L{_wait_for} loops check their condition."""
+    for loop in _waiting_loops:
+        loop.quit()
+
 def _debug(obj, linefeed=True, outfd=sys.stderr, outputencoding="utf8"):
     """Print a debug info line to stream channel"""
     if isinstance(obj, unicode):
@@ -749,6 +2085,27 @@ def _debug(obj, linefeed=True, outfd=sys.stderr, outputencoding="utf8"):
     outfd.write(strobj)
     outfd.flush()
      
+class _DebugStreamHandler(logging.Handler):
+    """
+    Logging handler that writes the lines of each browser, up to its
+    debug level, to its debug stream.
+    """
+    def filter(self, record):
+        browser = getattr(record, "spynner_browser", None)
+        return (browser is not None and 
+            record.levelno >= _logging_levels[browser.debug_level] and 
+            logging.Handler.filter(self, record))
+        
+    def emit(self, record):
+        try:
+            _debug(self.format(record), outfd=record.spynner_browser.debug_stream)
+        except Exception:
+            self.handleError(record)
+
+_logger = logging.getLogger("spynner.browser")
+_debug_handler = _DebugStreamHandler()
+_logger.addHandler(_debug_handler)
+
 class SpynnerError(Exception):
     """General Spynner error."""
 
@@ -761,6 +2118,400 @@ class SpynnerTimeout(Exception):
 class SpynnerJavascriptError(Exception):
     """Error on the injected Javascript code.""" 
                    
+class ActionBatch:
+    """
+    Form actions queued to run in a single Javascript evaluation (see 
+    L{Browser.batch}). Selectors are jQuery selectors.
+    """
+    _jscodes = {
+        "fill": "e.val(%(value)s)",
+        "check": "e.attr('checked', true)",
+        "uncheck": "e.attr('checked', false)",
+        "select": "e.attr('selected', 'selected')",
+        "choose": "e.simulate('click')",
+        "click": "e.simulate('click')",
+    }
+    
+    def __init__(self, browser):
+        self.browser = browser
+        self.actions = []
+        """Queued actions: list of (name, selector, jscode)."""
+        self.results = None
+        """List of (name, selector, success) for the last flush."""
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        
+    def _add(self, name, selector, value=None):
+        jscode = self._jscodes[name] % dict(value=json.dumps(value))
+        self.actions.append((name, selector, jscode))
+
+    def fill(self, selector, value):
+        """Queue a L{Browser.fill} action."""
+        self._add("fill", selector, value)
+
+    def check(self, selector):
+        """Queue a L{Browser.check} action."""
+        self._add("check", selector)
+
+    def uncheck(self, selector):
+        """Queue a L{Browser.uncheck} action."""
+        self._add("uncheck", selector)
+
+    def select(self, selector):
+        """Queue a L{Browser.select} action."""
+        self._add("select", selector)
+
+    def choose(self, selector):
+        """Queue a L{Browser.choose} action."""
+        self._add("choose", selector)
+
+    def click(self, selector):
+        """Queue a click (it does not wait for anything)."""
+        self._add("click", selector)
+        
+    def flush(self):
+        """
+        Run queued actions and return a list of (name, selector, success),
+        where C{success} tells if the selector matched some element.
+        """
+        lines = ["(function($) {", "var r = [], e;"]
+        for name, selector, jscode in self.actions:
+            lines.append("try { e = $(%s); if (e.length) %s; r.push(e.length > 0); }"
+                " catch (err) { r.push(false); }" % (json.dumps(selector), jscode))
+        lines.append("return r; })(%s);" % self.browser.jslib)
+        self.browser.inject_jquery()
+        values = self.browser.runjs("\n".join(lines)).toList()
+        self.results = [(name, selector, value.toBool()) for ((name, selector, 
+            jscode), value) in zip(self.actions, values)]
+        self.actions = []
+        return self.results
+
+class RequestRecord:
+    """A network request made by a L{Browser}."""
+    def __init__(self, seq, operation, url, initiator=None):
+        self.seq = seq
+        """Sequence number of the request in the browser."""
+        self.operation = operation
+        """HTTP operation (C{get}, C{head}, C{post} or C{put})."""
+        self.url = url
+        """Requested URL."""
+        self.initiator = initiator
+        """URL of the frame that made the request (None if unknown)."""
+        self.started = time.time()
+        """Time when the request was made."""
+        self.first_byte = None
+        """Time when the reply headers were received."""
+        self.finished = None
+        """Time when the reply finished (None if still running)."""
+        self.error = None
+        """QNetworkReply error code (0 means no error)."""
+        self.status = None
+        """HTTP status code."""
+        self.status_text = ""
+        """HTTP reason phrase."""
+        self.content_type = ""
+        """Content-Type of the reply."""
+        self.size = 0
+        """Bytes received."""
+        self.request_size = 0
+        """Bytes of the request body."""
+        self.request_headers = []
+        """Request headers (list of C{(name, value)} pairs)."""
+        self.response_headers = []
+        """Reply headers (list of C{(name, value)} pairs)."""
+        self.from_cache = False
+        """True if the reply was served from the cache."""
+
+    def _get_ttfb(self):
+        if self.first_byte is not None:
+            return self.first_byte - self.started
+
+    def _get_elapsed(self):
+        if self.finished is not None:
+            return self.finished - self.started
+
+    ttfb = property(_get_ttfb)
+    """Seconds from the request to the first byte of the reply (or None)."""
+
+    elapsed = property(_get_elapsed)
+    """Seconds from the request to the end of the reply (or None)."""
+
+class DownloadResult:
+    """Result of a download (see L{Browser.idownload_many})."""
+    def __init__(self, url, status, nbytes=0, elapsed=None, error=None, path=None):
+        self.url = url
+        """Downloaded URL."""
+        self.status = status
+        """True if the download was successful."""
+        self.nbytes = nbytes
+        """Bytes downloaded."""
+        self.elapsed = elapsed
+        """Time (seconds) spent on the download."""
+        self.error = error
+        """Error string (None if the download was successful)."""
+        self.path = path
+        """Path of the file where data was saved (if any)."""
+
+class _CallbackWriter:
+    """File-like object that passes written data to a callback."""
+    def __init__(self, callback, url):
+        self.callback = callback
+        self.url = url
+        
+    def write(self, data):
+        self.callback(self.url, data)
+
+class _JavascriptBridge(QObject):
+    """Object exposed as C{_spynner} to the Javascript context of a frame."""
+    def __init__(self, browser, webframe):
+        QObject.__init__(self, webframe)
+        self.browser = browser
+        self.webframe = webframe
+        self.dom_dirty = False
+
+    def on_window_object_cleared(self):
+        self.browser._on_javascript_window_cleared(self.webframe, self)
+        
+    @pyqtSlot()
+    def injectJQuery(self):
+        self.browser._inject_jquery(self.webframe)
+
+    @pyqtSlot()
+    def domChanged(self):
+        self.browser._on_dom_changed()
+
+    def _get_dom_dirty(self):
+        return self.dom_dirty
+        
+    domDirty = pyqtProperty(bool, _get_dom_dirty)
+
+class _UrlRules:
+    """Compiled set of URL blocking rules (see L{Browser.set_url_rules})."""
+    _domain_re = re.compile(r"^[\w\-]+(\.[\w\-]+)+$")
+    _keyword_re = re.compile(r"(?<=[^a-z0-9%*])[a-z0-9%]{3,}(?=[^a-z0-9%*])")
+    _token_re = re.compile(r"[a-z0-9%]{3,}")
+    
+    def __init__(self, rules):
+        self.block_domains = set()
+        self.allow_domains = set()
+        # Patterns indexed by keyword (a token that any matching URL has, 
+        # "" for patterns with no keyword), like Adblock Plus matcher does.
+        # Items are (rule, is_adblock) pairs until first used, then they 
+        # are replaced by the compiled regular expression.
+        self.block_patterns = {}
+        self.allow_patterns = {}
+        for rule in rules:
+            if hasattr(rule, "pattern"):
+                self.block_patterns.setdefault("", []).append(rule)
+                continue
+            rule = rule.strip()
+            if not rule or rule.startswith("!") or rule.startswith("[") or \
+                    "##" in rule or "#@#" in rule:
+                continue
+            domains, patterns = self.block_domains, self.block_patterns
+            if rule.startswith("@@"):
+                domains, patterns = self.allow_domains, self.allow_patterns
+                rule = rule[2:]
+            if len(rule) > 2 and rule.startswith("/") and rule.endswith("/"):
+                patterns.setdefault("", []).append((rule[1:-1], False))
+            elif "$" in rule:
+                # Filter options are not supported, skip the rule
+                continue
+            elif self._domain_re.match(rule):
+                domains.add(rule.lower())
+            elif rule.startswith("||") and rule.endswith("^") and \
+                    self._domain_re.match(rule[2:-1]):
+                domains.add(rule[2:-1].lower())
+            else:
+                keyword = self._get_keyword(rule, patterns)
+                patterns.setdefault(keyword, []).append((rule, True))
+        
+    @classmethod
+    def _get_keyword(cls, rule, patterns):
+        """Return the least used keyword of an Adblock rule ("" if none)."""
+        text = rule.lower()
+        text = (text if text.startswith("|") else "*" + text)
+        text = (text if text.endswith("|") or text.endswith("^") else text + "*")
+        keywords = cls._keyword_re.findall(text)
+        if not keywords:
+            return ""
+        return min(keywords, key=lambda keyword: len(patterns.get(keyword, ())))
+        
+    @staticmethod
+    def _adblock_to_regexp(rule):
+        prefix = suffix = ""
+        if rule.startswith("||"):
+            prefix = r"^[\w\-]+:/+(?:[^/?#]*\.)?"
+            rule = rule[2:]
+        elif rule.startswith("|"):
+            prefix = "^"
+            rule = rule[1:]
+        if rule.endswith("|"):
+            suffix = "$"
+            rule = rule[:-1]
+        special = {"*": ".*", "^": r"(?:[^\w\-.%]|$)"}
+        return prefix + "".join(special.get(c) or re.escape(c) for c in rule) + suffix
+        
+    @staticmethod
+    def _domain_matches(host, domains):
+        if not domains:
+            return False
+        parts = host.split(".")
+        return any(".".join(parts[i:]) in domains for i in range(len(parts)))
+        
+    def _patterns_match(self, url, tokens, patterns):
+        for keyword in itertools.chain([""], tokens):
+            candidates = patterns.get(keyword)
+            if not candidates:
+                continue
+            for index, pattern in enumerate(candidates):
+                if isinstance(pattern, tuple):
+                    rule, is_adblock = pattern
+                    if is_adblock:
+                        rule = self._adblock_to_regexp(rule)
+                    pattern = candidates[index] = re.compile(rule, re.IGNORECASE)
+                if pattern.search(url):
+                    return True
+        return False
+        
+    def match(self, url):
+        """Return True if URL must be blocked."""
+        host = (urlparse.urlsplit(url).hostname or "")
+        tokens = set(self._token_re.findall(url.lower()))
+        if self._domain_matches(host, self.allow_domains) or \
+                self._patterns_match(url, tokens, self.allow_patterns):
+            return False
+        if self._domain_matches(host, self.block_domains):
+            return True
+        return self._patterns_match(url, tokens, self.block_patterns)
+
+class _BlockedReply(QNetworkReply):
+    """Network reply that fails immediately, used for blocked requests."""
+    def __init__(self, parent, request, operation):
+        QNetworkReply.__init__(self, parent)
+        self.setRequest(request)
+        self.setUrl(request.url())
+        self.setOperation(operation)
+        self.open(QIODevice.ReadOnly | QIODevice.Unbuffered)
+        self.setError(QNetworkReply.ContentAccessDenied, "Blocked by spynner")
+        self._finished = False
+        QTimer.singleShot(0, self._finish)
+        
+    def _finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        self.setFinished(True)
+        self.emit(SIGNAL("error(QNetworkReply::NetworkError)"), 
+            QNetworkReply.ContentAccessDenied)
+        self.emit(SIGNAL("finished()"))
+        
+    def abort(self):
+        # Like any other reply, an aborted one must emit finished()
+        self._finish()
+        
+    def bytesAvailable(self):
+        return 0
+        
+    def readData(self, maxlen):
+        return None
+
+class _ImageWriter(QObject):
+    """Pool of threads that encode and save images."""
+    def __init__(self, nthreads, max_pending):
+        QObject.__init__(self)
+        self.max_pending = max_pending
+        self.pending = 0
+        self._queue = Queue.Queue()
+        self.connect(self, SIGNAL("imageSaved"), self._on_image_saved, 
+            Qt.QueuedConnection)
+        for n in range(nthreads):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            
+    def _run(self):
+        while True:
+            image, path, format, quality, callback = self._queue.get()
+            try:
+                ok = image.save(path, format, quality)
+            except Exception:
+                ok = False
+            # Queued signal: the slot is run by the main thread event loop
+            self.emit(SIGNAL("imageSaved"), path, ok, callback)
+            
+    def _on_image_saved(self, path, ok, callback):
+        self.pending -= 1
+        _wake_up()
+        if callback:
+            callback(path, ok)
+        
+    def put(self, image, path, format, quality, callback):
+        _wait_for(lambda: self.pending < self.max_pending)
+        self.pending += 1
+        self._queue.put((image, path, format, quality, callback))
+
+class _LRUDiskCache(QNetworkDiskCache):
+    """QNetworkDiskCache that evicts least recently used entries first."""
+    def __init__(self, parent=None):
+        QNetworkDiskCache.__init__(self, parent)
+        self._last_access = {}
+        # Estimated size (like Qt does, 1024 bytes per header), None if 
+        # unknown. It only grows until the next scan of the directory.
+        self._size = None
+        
+    def insert(self, device):
+        if self._size is not None:
+            self._size += device.size() + 1024
+        QNetworkDiskCache.insert(self, device)
+        
+    def clear(self):
+        QNetworkDiskCache.clear(self)
+        self._size = 0
+        
+    def data(self, url):
+        device = QNetworkDiskCache.data(self, url)
+        if device:
+            self._last_access[unicode(url.toString())] = time.time()
+        return device
+        
+    def expire(self):
+        # Qt calls expire() after every insertion, only scan when over budget
+        if self._size is not None and self._size < self.maximumCacheSize():
+            return self._size
+        entries = []
+        total = 0
+        directory = unicode(self.cacheDirectory())
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                url = self.fileMetaData(path).url()
+                if not url.isValid():
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                surl = unicode(url.toString())
+                last_access = max(stat.st_mtime, self._last_access.get(surl, 0))
+                entries.append((last_access, stat.st_size, url))
+                total += stat.st_size
+        # Leave some room so we don't expire on every insertion
+        limit = self.maximumCacheSize() * 9 / 10
+        for last_access, size, url in sorted(entries):
+            if total <= limit:
+                break
+            if self.remove(url):
+                self._last_access.pop(unicode(url.toString()), None)
+                total -= size
+        self._size = total
+        return total
+
 class _ExtendedNetworkCookieJar(QNetworkCookieJar):
     def mozillaCookies(self):
         """
@@ -809,3 +2560,184 @@ class _ExtendedNetworkCookieJar(QNetworkCookieJar):
         cookies = [get_cookie(line) for line in string_cookies.splitlines() 
           if line.strip() and not line.strip().startswith("#")]
         self.setAllCookies(filter(bool, cookies))
+
+    def cookieRows(self):
+        """
+        Return all cookies as tuples C{(domain, path, name, value, 
+        expiration, secure, http_only)}, with no loss of information 
+        (unlike L{mozillaCookies}, session and HTTP-only cookies are kept).
+        """
+        return map(_cookie_to_row, self.allCookies())
+
+    def setCookieRows(self, rows):
+        """Set all cookies from tuples returned by L{cookieRows}."""
+        self.setAllCookies(map(_cookie_from_row, rows))
+
+def _get_cookie_domains(host):
+    """Return the cookie domains that may apply to a host."""
+    parts = host.lower().split(".")
+    domains = []
+    for index in range(len(parts)):
+        domain = ".".join(parts[index:])
+        domains.extend([domain, "." + domain])
+    return domains
+
+def _cookie_to_row(cookie):
+    expires = (None if cookie.isSessionCookie() else 
+        cookie.expirationDate().toTime_t())
+    return (unicode(cookie.domain()), unicode(cookie.path()), 
+        unicode(str(cookie.name()), "latin-1"), str(cookie.value()), 
+        expires, int(cookie.isSecure()), int(cookie.isHttpOnly()))
+
+def _cookie_row_to_json(row):
+    # Cookie values are byte strings, JSON only holds unicode
+    return row[:3] + (unicode(row[3], "latin-1"),) + row[4:]
+
+def _cookie_row_from_json(row):
+    row = tuple(row)
+    return row[:3] + (row[3].encode("latin-1"),) + row[4:]
+
+def _cookie_from_row(row):
+    domain, path, name, value, expires, secure, http_only = row
+    cookie = QNetworkCookie(name.encode("latin-1"), str(value))
+    cookie.setDomain(domain)
+    cookie.setPath(path)
+    cookie.setSecure(bool(secure))
+    cookie.setHttpOnly(bool(http_only))
+    if expires is not None:
+        cookie.setExpirationDate(QDateTime.fromTime_t(expires))
+    return cookie
+
+class SqliteCookieJar(_ExtendedNetworkCookieJar):
+    """
+    Cookie jar persisted in a SQLite database.
+    
+    Cookies are written to the database as soon as they are set, and read 
+    lazily, only for the domains of the requested URLs. Domains already 
+    read are refreshed from the database every L{refresh_interval} seconds,
+    so browsers in other processes using the same database file see the 
+    cookies set by each other (a logged-in session, for example).
+    
+    >>> jar = SqliteCookieJar("cookies.db")
+    >>> browser.set_cookie_jar(jar)
+    
+    A jar (and its database connection) must not be shared between 
+    processes, create one in each process with the same path instead.
+    """
+    
+    refresh_interval = 5.0
+    """@ivar: Seconds before the cookies of a domain are read again from
+    the database (None to never read them again)."""
+    
+    _columns = "domain, path, name, value, expires, secure, http_only"
+    
+    def __init__(self, path, refresh_interval=None, parent=None):
+        """
+        Init a SqliteCookieJar, creating the database if necessary.
+        
+        @param path: Database file path.
+        @param refresh_interval: See L{refresh_interval}.
+        @param parent: Parent QObject.
+        """
+        _ExtendedNetworkCookieJar.__init__(self, parent)
+        if refresh_interval is not None:
+            self.refresh_interval = refresh_interval
+        self.path = path
+        """Database file path."""
+        self._db = sqlite3.connect(path, timeout=30)
+        # WAL journaling lets readers of other processes go on while writing
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # The primary key index (starting with domain) is used for lookups
+        self._db.execute("CREATE TABLE IF NOT EXISTS cookies ("
+            "domain TEXT NOT NULL, path TEXT NOT NULL, name TEXT NOT NULL, "
+            "value BLOB, expires INTEGER, secure INTEGER, http_only INTEGER, "
+            "PRIMARY KEY (domain, path, name))")
+        self._loaded_domains = {}
+        self.expire()
+
+    def _load_domains(self, domains):
+        now = time.time()
+        interval = self.refresh_interval
+        domains = [domain for domain in domains 
+            if domain not in self._loaded_domains or (interval is not None 
+                and now - self._loaded_domains[domain] > interval)]
+        if not domains:
+            return
+        rows = self._db.execute("SELECT %s FROM cookies WHERE domain IN (%s)" % 
+            (self._columns, ", ".join("?" * len(domains))), domains).fetchall()
+        for domain in domains:
+            self._loaded_domains[domain] = now
+        loaded = set(domains)
+        cookies = [cookie for cookie in self.allCookies() 
+            if unicode(cookie.domain()) not in loaded]
+        cookies.extend(_cookie_from_row(row) for row in rows)
+        self.setAllCookies(cookies)
+        
+    def _load_all(self):
+        now = time.time()
+        rows = self._db.execute("SELECT %s FROM cookies" % 
+            self._columns).fetchall()
+        for row in rows:
+            self._loaded_domains[row[0]] = now
+        self.setAllCookies([_cookie_from_row(row) for row in rows])
+
+    def _save(self, cookies, domains=None, names=None):
+        """Replace cookies in the database (all if no domain is given)."""
+        with self._db:
+            if domains is None:
+                self._db.execute("DELETE FROM cookies")
+            else:
+                for domain in domains:
+                    self._db.executemany("DELETE FROM cookies WHERE "
+                        "domain = ? AND name = ?", 
+                        [(domain, name) for name in names])
+            rows = [row[:3] + (sqlite3.Binary(row[3]),) + row[4:] 
+                for row in map(_cookie_to_row, cookies)]
+            self._db.executemany("INSERT OR REPLACE INTO cookies (%s) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)" % self._columns, rows)
+    
+    def cookiesForUrl(self, url):
+        self._load_domains(_get_cookie_domains(unicode(url.host())))
+        return _ExtendedNetworkCookieJar.cookiesForUrl(self, url)
+
+    def setCookiesFromUrl(self, cookies, url):
+        domains = _get_cookie_domains(unicode(url.host()))
+        self._load_domains(domains)
+        if not _ExtendedNetworkCookieJar.setCookiesFromUrl(self, cookies, url):
+            return False
+        # Save the current state (new, updated or removed) of those cookies
+        names = set(unicode(str(cookie.name()), "latin-1") for cookie in cookies)
+        current = [cookie for cookie in self.allCookies() 
+            if unicode(cookie.domain()) in domains and 
+                unicode(str(cookie.name()), "latin-1") in names]
+        self._save(current, domains, names)
+        return True
+
+    def mozillaCookies(self):
+        self._load_all()
+        return _ExtendedNetworkCookieJar.mozillaCookies(self)
+
+    def setMozillaCookies(self, string_cookies):
+        _ExtendedNetworkCookieJar.setMozillaCookies(self, string_cookies)
+        self._save(self.allCookies())
+
+    def cookieRows(self):
+        self._load_all()
+        return _ExtendedNetworkCookieJar.cookieRows(self)
+
+    def setCookieRows(self, rows):
+        _ExtendedNetworkCookieJar.setCookieRows(self, rows)
+        self._save(self.allCookies())
+
+    def expire(self):
+        """Remove expired cookies from memory and the database."""
+        with self._db:
+            self._db.execute("DELETE FROM cookies WHERE expires IS NOT NULL "
+                "AND expires <= ?", (int(time.time()),))
+        now = QDateTime.currentDateTime()
+        self.setAllCookies([cookie for cookie in self.allCookies() 
+            if cookie.isSessionCookie() or cookie.expirationDate() > now])
+
+    def close(self):
+        """Close the database."""
+        self._db.close()
@@ -0,0 +1,294 @@
+#!/usr/bin/python
+
+# Copyright (c) Arnau Sanchez <tokland@gmail.com>
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+"""
+Farm of worker processes, each one running its own L{Browser}.
+
+WebKit is single-threaded, so the only way to use many cores is to run
+many processes. A job is a URL plus a script of actions, a list whose
+items are either tuples C{(method_name, arg1, arg2, ...)} called on the
+worker browser (C{("fill", "input[name=q]", "spynner")}, C{("html",)} for
+properties) or module-level functions C{action(browser)}. Jobs and
+results must be picklable (a job whose values are not gets an error 
+result).
+
+>>> farm = BrowserFarm(processes=8, max_pages=100)
+>>> for url in urls:
+...     farm.submit(url, [("click_link", "a:first"), ("html",)])
+>>> for result in farm.results():
+...     print result.url, result.error or len(result.values[-1])
+>>> farm.close()
+
+Create the farm before any Browser is created in the parent process,
+worker processes are forked and must not inherit a running QApplication.
+"""
+
+import multiprocessing
+import cPickle
+import itertools
+import traceback
+import signal
+import Queue
+import time
+
+from PyQt4.QtCore import QVariant, QString
+
+from browser import Browser, SpynnerError
+
+class FarmJob:
+    """A job to be run by a worker of L{BrowserFarm}."""
+
+    def __init__(self, job_id, url, actions):
+        self.job_id = job_id
+        """Job identifier (an integer)."""
+        self.url = url
+        """URL to load before running the actions (None to skip)."""
+        self.actions = actions
+        """List of actions (see module documentation)."""
+        self.attempts = 0
+        """Times the job has been sent to a worker."""
+
+class FarmResult:
+    """Result of a L{FarmJob}."""
+
+    def __init__(self, job, status=None, values=None, error=None, pid=None):
+        self.job_id = job.job_id
+        """Job identifier."""
+        self.url = job.url
+        """Job URL."""
+        self.status = status
+        """Load status (a boolean)."""
+        self.values = values or []
+        """Values returned by each action."""
+        self.error = error
+        """Error string (None if the job was successful)."""
+        self.pid = pid
+        """PID of the worker that run the job."""
+        self.attempts = job.attempts
+        """Times the job has been sent to a worker."""
+
+class _WorkerInitError:
+    """Sent by a worker whose browser could not be initialized."""
+
+    def __init__(self, error):
+        self.error = error
+
+def _check_action(action):
+    if callable(action):
+        return
+    if not isinstance(action, tuple) or not action:
+        raise SpynnerError("Action must be a callable or a tuple: %r" % (action,))
+    name = action[0]
+    if name.startswith("_") or not hasattr(Browser, name):
+        raise SpynnerError("Unknown browser action: %s" % name)
+
+def _picklable(value):
+    if isinstance(value, QVariant):
+        value = value.toPyObject()
+    if isinstance(value, QString):
+        value = unicode(value)
+    return value
+
+def _run_job(browser, job):
+    status = (browser.load(job.url) if job.url else None)
+    values = []
+    for action in job.actions:
+        if callable(action):
+            value = action(browser)
+        else:
+            attr = getattr(browser, action[0])
+            value = (attr(*action[1:]) if callable(attr) else attr)
+        values.append(_picklable(value))
+    return status, values
+
+def _worker(jobs, results, worker_id, init, debug_level):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        browser = Browser(debug_level=debug_level)
+        if init:
+            init(browser)
+    except Exception:
+        # A new worker would fail the same way, let the farm report it
+        error = _WorkerInitError(traceback.format_exc())
+        results.put((worker_id, cPickle.dumps(error, cPickle.HIGHEST_PROTOCOL)))
+        return
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        pid = multiprocessing.current_process().pid
+        try:
+            status, values = _run_job(browser, job)
+            result = FarmResult(job, status, values, pid=pid)
+            # Pickle here: errors in the queue feeder thread are lost
+            data = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            result = FarmResult(job, error=traceback.format_exc(), pid=pid)
+            data = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+        results.put((worker_id, data))
+    browser.close()
+
+class _Worker:
+    def __init__(self, worker_id, process, jobs):
+        self.worker_id = worker_id
+        self.process = process
+        self.jobs = jobs
+        self.job = None
+        self.job_started = None
+        self.pages = 0
+
+class BrowserFarm:
+    """Run jobs on a set of worker processes (see module documentation)."""
+
+    poll_interval = 0.5
+    """@ivar: Seconds between checks of the worker processes health."""
+
+    def __init__(self, processes=None, max_pages=100, max_retries=1,
+                 job_timeout=None, init=None, debug_level=None):
+        """
+        Init a BrowserFarm and start its worker processes.
+
+        @param processes: Number of workers (default: number of CPUs).
+        @param max_pages: Jobs run by a worker before it is replaced by
+                          a fresh one (None: no limit).
+        @param max_retries: Times a job is retried when its worker crashes.
+        @param job_timeout: Seconds after which the worker running a job
+                            is killed (handled like a crash).
+        @param init: Module-level function C{init(browser)} called on
+                     every new worker browser (to log in, for example).
+                     If it fails, L{results} raises an error.
+        @param debug_level: Debug level logging for worker browsers.
+        """
+        self.processes = processes or multiprocessing.cpu_count()
+        self.max_pages = max_pages
+        self.max_retries = max_retries
+        self.job_timeout = job_timeout
+        self._init = init
+        self._init_error = None
+        self._debug_level = debug_level
+        self._results = multiprocessing.Queue()
+        self._job_ids = itertools.count()
+        self._worker_ids = itertools.count()
+        self._queue = []
+        self._pending = {}
+        self._workers = {}
+        for n in range(self.processes):
+            self._start_worker()
+
+    def _start_worker(self):
+        worker_id = self._worker_ids.next()
+        jobs = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_worker, args=(jobs,
+            self._results, worker_id, self._init, self._debug_level))
+        process.daemon = True
+        process.start()
+        self._workers[worker_id] = _Worker(worker_id, process, jobs)
+
+    def _retire_worker(self, worker):
+        worker.jobs.put(None)
+        del self._workers[worker.worker_id]
+        worker.process.join()
+        self._start_worker()
+
+    def _dispatch(self):
+        for worker in self._workers.values():
+            while worker.job is None and self._queue:
+                job = self._queue.pop(0)
+                if job.job_id not in self._pending:
+                    continue
+                job.attempts += 1
+                worker.job = job
+                worker.job_started = time.time()
+                worker.jobs.put(job)
+
+    def _check_workers(self):
+        failed = []
+        now = time.time()
+        for worker in self._workers.values():
+            if (self.job_timeout and worker.job and
+                    now - worker.job_started > self.job_timeout):
+                worker.process.terminate()
+                worker.process.join()
+                error = "Job timeout (%s seconds)" % self.job_timeout
+            elif not worker.process.is_alive():
+                error = "Worker crashed (exit code %s)" % worker.process.exitcode
+            else:
+                continue
+            del self._workers[worker.worker_id]
+            job = worker.job
+            if job and job.job_id in self._pending:
+                if job.attempts <= self.max_retries:
+                    self._queue.insert(0, job)
+                else:
+                    del self._pending[job.job_id]
+                    failed.append(FarmResult(job, error=error,
+                        pid=worker.process.pid))
+            self._start_worker()
+        return failed
+
+    def submit(self, url, actions=()):
+        """
+        Add a job to the farm queue and return its identifier.
+
+        @param url: URL to load (None to run the actions on the current page).
+        @param actions: List of actions (see module documentation).
+        """
+        actions = list(actions)
+        for action in actions:
+            _check_action(action)
+        job = FarmJob(self._job_ids.next(), url, actions)
+        self._queue.append(job)
+        self._pending[job.job_id] = job
+        return job.job_id
+
+    def results(self):
+        """
+        Yield L{FarmResult} objects as jobs finish, until all submitted
+        jobs are done.
+
+        @raise SpynnerError: If the C{init} function failed on a worker.
+        """
+        while self._pending:
+            if self._init_error:
+                raise SpynnerError("Worker init failed:\n%s" % self._init_error)
+            self._dispatch()
+            try:
+                worker_id, data = self._results.get(timeout=self.poll_interval)
+                result = cPickle.loads(data)
+            except Queue.Empty:
+                result = None
+            if isinstance(result, _WorkerInitError):
+                self._init_error = result.error
+                continue
+            if result:
+                worker = self._workers.get(worker_id)
+                if worker and worker.job and worker.job.job_id == result.job_id:
+                    worker.job = None
+                    worker.pages += 1
+                    if self.max_pages and worker.pages >= self.max_pages:
+                        self._retire_worker(worker)
+                if self._pending.pop(result.job_id, None):
+                    yield result
+            for result in self._check_workers():
+                yield result
+
+    def close(self):
+        """Stop all worker processes."""
+        for worker in self._workers.values():
+            worker.jobs.put(None)
+        for worker in self._workers.values():
+            worker.process.join()
+        self._workers = {}
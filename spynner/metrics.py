@@ -0,0 +1,122 @@
+#!/usr/bin/python
+
+# Copyright (c) Arnau Sanchez <tokland@gmail.com>
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+"""
+Counters and latency histograms of browsers.
+
+Every L{Browser} has a C{metrics} attribute (a L{Metrics} object) updated
+as pages are loaded, requests finish, Javascript code is run and files are
+downloaded. All browser metrics are also added to L{process_metrics}, the
+aggregate of the process (useful for pools of browsers).
+
+>>> browser.load("http://www.wordreference.com")
+>>> print browser.metrics.counters["pages_loaded_total"]
+>>> print process_metrics.to_prometheus()
+"""
+
+import bisect
+
+# Default histogram buckets (seconds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0, 30.0, 60.0)
+
+_counters = {
+    "pages_loaded_total": "Pages loaded successfully.",
+    "page_load_failures_total": "Page loads that failed.",
+    "timeouts_total": "Page loads that timed out.",
+    "requests_total": "Network requests finished.",
+    "request_errors_total": "Network requests finished with an error.",
+    "bytes_received_total": "Bytes received by network requests.",
+    "js_evaluations_total": "Javascript evaluations.",
+    "downloads_total": "Files downloaded.",
+    "download_bytes_total": "Bytes downloaded.",
+}
+
+_histograms = {
+    "page_load_seconds": "Page load time.",
+    "request_seconds": "Network request time.",
+    "js_evaluation_seconds": "Javascript evaluation time.",
+    "download_seconds": "Download time.",
+}
+
+class Histogram:
+    """Fixed-bucket histogram."""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        """Upper bounds of the buckets (an infinite bucket is implicit)."""
+        self.counts = [0] * (len(self.buckets) + 1)
+        """Observations on each bucket (not cumulative)."""
+        self.count = 0
+        """Total number of observations."""
+        self.sum = 0.0
+        """Sum of all observed values."""
+
+    def observe(self, value):
+        """Add a value to the histogram."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+class Metrics:
+    """Set of counters and histograms."""
+    def __init__(self, parent=None):
+        """
+        Init a Metrics object.
+
+        @param parent: L{Metrics} object also updated on every change.
+        """
+        self.parent = parent
+        self.counters = dict((name, 0) for name in _counters)
+        """Counter values (dictionary C{name: value})."""
+        self.histograms = dict((name, Histogram()) for name in _histograms)
+        """Histograms (dictionary C{name: L{Histogram}})."""
+
+    def inc(self, name, value=1):
+        """Increment a counter."""
+        self.counters[name] += value
+        if self.parent:
+            self.parent.inc(name, value)
+
+    def observe(self, name, value):
+        """Add a value to a histogram."""
+        self.histograms[name].observe(value)
+        if self.parent:
+            self.parent.observe(name, value)
+
+    def to_prometheus(self, prefix="spynner"):
+        """Return metrics in Prometheus text exposition format."""
+        lines = []
+        for name in sorted(self.counters):
+            fullname = "%s_%s" % (prefix, name)
+            lines.append("# HELP %s %s" % (fullname, _counters[name]))
+            lines.append("# TYPE %s counter" % fullname)
+            lines.append("%s %s" % (fullname, self.counters[name]))
+        for name in sorted(self.histograms):
+            fullname = "%s_%s" % (prefix, name)
+            histogram = self.histograms[name]
+            lines.append("# HELP %s %s" % (fullname, _histograms[name]))
+            lines.append("# TYPE %s histogram" % fullname)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",),
+                                    histogram.counts):
+                cumulative += count
+                lines.append('%s_bucket{le="%s"} %d' % (fullname, bound, cumulative))
+            lines.append("%s_sum %r" % (fullname, histogram.sum))
+            lines.append("%s_count %d" % (fullname, histogram.count))
+        return "\n".join(lines) + "\n"
+
+process_metrics = Metrics()
+"""Aggregated metrics of all the browsers in the process."""
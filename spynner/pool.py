@@ -0,0 +1,170 @@
+#!/usr/bin/python
+
+# Copyright (c) Arnau Sanchez <tokland@gmail.com>
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+"""
+Pool of browsers running concurrently on the event loop of a single 
+QApplication.
+"""
+
+import collections
+import time
+
+from PyQt4.QtCore import QUrl
+from PyQt4.QtWebKit import QWebPage
+
+from browser import Browser, SpynnerTimeout, _ExtendedNetworkCookieJar
+from browser import _get_application, _wait_for
+
+class PoolJob:
+    """A load/scrape job submitted to a L{BrowserPool}."""
+    
+    def __init__(self, url, scrape=None):
+        self.url = url
+        """URL to load."""
+        self.scrape = scrape
+        """Callback C{scrape(browser)} run when the page has been loaded."""
+        self.status = None
+        """Load status (a boolean), None while the job has not finished."""
+        self.result = None
+        """Value returned by the scrape callback."""
+        self.error = None
+        """Exception raised while processing the job, if any."""
+        self.done = False
+        """True when the job has been processed."""
+
+class BrowserPool:
+    """
+    Pool of L{Browser} workers sharing a single QApplication. 
+    
+    Pages are loaded concurrently on the same event loop; scrape callbacks 
+    are called (one at a time) as soon as its page has been loaded.
+    
+    >>> pool = BrowserPool(4)
+    >>> for url in urls:
+    ...     pool.submit(url, lambda browser: browser.html)
+    >>> for job in pool.run():
+    ...     print job.url, job.status, len(job.result or "")
+    >>> pool.close()
+    """
+    
+    def __init__(self, size=4, share_cookies=True, timeout=None, 
+                 qappargs=None, debug_level=None):
+        """
+        Init a BrowserPool instance.
+        
+        @param size: Number of browsers (pages loaded concurrently).
+        @param share_cookies: If True, all browsers use the same cookie jar.
+        @param timeout: Seconds to wait for a page to load (None: no limit).
+        @param qappargs: Arguments for QApplication constructor.
+        @param debug_level: Debug level logging for browsers.
+        """
+        self.application = _get_application(qappargs)
+        """PyQt4.QtGui.Qapplication object."""
+        self.browsers = [Browser(qappargs, debug_level) for n in range(size)]
+        """List of L{Browser} workers."""
+        self.cookiesjar = None
+        """Shared cookie jar (None if cookies are not shared)."""
+        if share_cookies:
+            self.cookiesjar = _ExtendedNetworkCookieJar()
+            for browser in self.browsers:
+                browser.set_cookie_jar(self.cookiesjar)
+        self.timeout = timeout
+        self._queue = collections.deque()
+        self._jobs = []
+        
+    def _next_timeout(self, running):
+        if not self.timeout:
+            return None
+        now = time.time()
+        deadline = min(itime + self.timeout for (job, itime) in running.values())
+        return max(deadline - now, 0.001)
+        
+    def _start_job(self, browser, job):
+        browser._load_status = None
+        browser.webframe.load(QUrl(job.url))
+        
+    def _finish_job(self, browser, job):
+        try:
+            job.status = browser._wait_load()
+            if job.status and job.scrape:
+                job.result = job.scrape(browser)
+        except Exception, exc:
+            job.error = exc
+        job.done = True
+        
+    def _abort_job(self, browser, job):
+        browser.webpage.triggerAction(QWebPage.Stop)
+        browser._load_status = None
+        job.status = False
+        job.error = SpynnerTimeout("Timeout reached: %s seconds" % self.timeout)
+        job.done = True
+
+    def submit(self, url, scrape=None):
+        """
+        Add a job to the pool queue and return it (a L{PoolJob}).
+        
+        @param url: URL to load.
+        @param scrape: Callback C{scrape(browser)} to call when the page 
+                       is loaded. Its return value is stored in the job.
+                       
+        Scrape callbacks may submit new jobs. 
+        """
+        job = PoolJob(url, scrape)
+        self._queue.append(job)
+        self._jobs.append(job)
+        return job
+
+    def run(self):
+        """Process all the queued jobs and return them in submission order."""
+        running = {}
+        idle = list(self.browsers)
+        while self._queue or running:
+            while self._queue and idle:
+                browser = idle.pop(0)
+                job = self._queue.popleft()
+                self._start_job(browser, job)
+                running[browser] = (job, time.time())
+            try:
+                _wait_for(lambda: any(browser._load_status is not None 
+                    for browser in running), self._next_timeout(running))
+            except SpynnerTimeout:
+                pass
+            now = time.time()
+            for browser, (job, itime) in running.items():
+                if browser._load_status is not None:
+                    self._finish_job(browser, job)
+                elif self.timeout and now - itime >= self.timeout:
+                    self._abort_job(browser, job)
+                else:
+                    continue
+                del running[browser]
+                idle.append(browser)
+        jobs, self._jobs = self._jobs, []
+        return jobs
+
+    def map(self, scrape, urls):
+        """
+        Load all URLs, call scrape(browser) for each one and return the 
+        list of results (None for pages that could not be loaded).
+        """
+        jobs = [self.submit(url, scrape) for url in urls]
+        self.run()
+        return [job.result for job in jobs]
+        
+    def close(self):
+        """Close all browsers in the pool."""
+        for browser in self.browsers:
+            browser.close()
@@ -0,0 +1 @@
+../../javascript/jquery.min.js
\ No newline at end of file
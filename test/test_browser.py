@@ -17,14 +17,22 @@
 
 import os
 import sys
+import time
+import json
+import logging
 import signal
+import shutil
+import tempfile
 import unittest
 import threading
 from StringIO import StringIO
 
 import spynner
+import spynner.farm
 import webserver
 from PyQt4.QtGui import QImage
+from PyQt4.QtCore import QUrl, SIGNAL
+from PyQt4.QtNetwork import QNetworkRequest, QNetworkCacheMetaData
              
 TESTDIR = os.path.dirname(__file__)
 TESTING_SERVER_PORT = 9876 
@@ -75,6 +83,19 @@ class SpynnerBrowserTest(unittest.TestCase):
     def test_html(self):
         self.assertTrue("Test1 HTML" in self.browser.html)
 
+    def test_html_is_cached(self):
+        self.assertTrue(self.browser.html is self.browser.html)
+
+    def test_html_cache_invalidated_on_dom_changes(self):
+        self.browser.html
+        self.browser.runjs("document.getElementById('link').innerHTML = 'one'")
+        self.assertTrue(">one<" in self.browser.html)
+        self.browser.runjs("setTimeout(function() {" + 
+            "document.getElementById('link').innerHTML = 'two';}, 10)")
+        self.browser.html
+        self.browser.wait(0.1)
+        self.assertTrue(">two<" in self.browser.html)
+
     def test_get_url(self):
         self.assertEqual(get_url("/test1.html"), self.browser.url)
 
@@ -86,10 +107,106 @@ class SpynnerBrowserTest(unittest.TestCase):
         self.assertRaises(spynner.SpynnerTimeout, 
             self.browser.wait_load, 0.1)
 
+    def test_wait(self):
+        itime = time.time()
+        self.browser.wait(0.2)
+        self.assertTrue(time.time() - itime >= 0.19)
+
+    def test_wait_request_raises_exception_on_timeout(self):
+        self.assertRaises(spynner.SpynnerTimeout, 
+            self.browser.click, "#check", wait_requests=1, timeout=0.1)
+
     def test_wait_request(self):
         self.browser.click("#link", wait_requests=1)
         self.assertEqual(get_url("/test3.html"), self.browser.url)
         
+    def test_wait_requests_with_match(self):
+        self.browser.click("#link")
+        self.browser.wait_requests(match="test3", timeout=1.0)
+        self.browser.wait_load(timeout=1.0)
+
+    def test_wait_network_idle(self):
+        self.browser.runjs("window.location = '/test2.html'")
+        itime = time.time()
+        self.browser.wait_network_idle(0.2, timeout=2.0)
+        self.assertTrue(time.time() - itime >= 0.19)
+        self.assertEqual(get_url("/test2.html"), self.browser.url)
+
+    def test_wait_network_idle_raises_exception_on_timeout(self):
+        self.assertRaises(spynner.SpynnerTimeout, 
+            self.browser.wait_network_idle, 1.0, timeout=0.2)
+
+    def test_requests_are_not_recorded_by_default(self):
+        self.assertEqual(0, len(self.browser.requests))
+        self.assertRaises(spynner.SpynnerError, self.browser.export_har)
+
+    def test_requests_are_recorded(self):
+        self.browser.record_requests = True
+        self.browser.load(get_url("/test1.html"))
+        record = self.browser.requests[0]
+        self.assertEqual(get_url("/test1.html"), record.url)
+        self.assertEqual(200, record.status)
+        self.assertTrue(record.size > 0)
+        self.assertTrue(0 <= record.ttfb <= record.elapsed)
+
+    def test_export_har(self):
+        self.browser.record_requests = True
+        self.browser.load(get_url("/test1.html"))
+        path = tempfile.mktemp(suffix=".har")
+        try:
+            self.browser.export_har(path)
+            har = json.load(open(path))
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+        self.assertEqual("1.2", har["log"]["version"])
+        self.assertEqual("Test1 HTML", har["log"]["pages"][0]["title"])
+        entry = har["log"]["entries"][0]
+        self.assertEqual(get_url("/test1.html"), entry["request"]["url"])
+        self.assertEqual(200, entry["response"]["status"])
+
+    def test_metrics(self):
+        process_pages = spynner.metrics.process_metrics.counters["pages_loaded_total"]
+        self.browser.load(get_url("/test1.html"))
+        self.browser.runjs("1 + 1")
+        counters = self.browser.metrics.counters
+        self.assertEqual(2, counters["pages_loaded_total"])
+        self.assertTrue(counters["requests_total"] >= 2)
+        self.assertTrue(counters["js_evaluations_total"] >= 1)
+        self.assertEqual(2, self.browser.metrics.histograms["page_load_seconds"].count)
+        self.assertEqual(process_pages + 1, 
+            spynner.metrics.process_metrics.counters["pages_loaded_total"])
+
+    def test_metrics_of_evaluations_and_downloads(self):
+        counters = self.browser.metrics.counters
+        evaluations = counters["js_evaluations_total"]
+        self.browser.evaluate("1 + 1")
+        self.browser.evaluate_on("#check", "this.id")
+        self.browser.set_value("input[name=user]", "john")
+        self.assertEqual(evaluations + 3, counters["js_evaluations_total"])
+        url = get_url('/test3.html')
+        size = len(open(get_file_path('test3.html')).read())
+        list(self.browser.iter_download(url))
+        self.browser.download_many([url], outfds={url: StringIO()})
+        self.assertEqual(2, counters["downloads_total"])
+        self.assertEqual(2 * size, counters["download_bytes_total"])
+        self.assertEqual(2, 
+            self.browser.metrics.histograms["download_seconds"].count)
+
+    def test_wait_for_selector(self):
+        self.browser.runjs("setTimeout(function() {" + 
+            "var span = document.createElement('span'); span.id = 'late';" + 
+            "document.body.appendChild(span);}, 50)")
+        element = self.browser.wait_for_selector("#late", timeout=1.0)
+        self.assertEqual("late", unicode(element.attribute("id")))
+        self.assertRaises(spynner.SpynnerTimeout, 
+            self.browser.wait_for_selector, "#nonexisting", 0.1)
+
+    def test_wait_for_js(self):
+        self.browser.runjs("setTimeout(function() {" + 
+            "document.title = 'changed';}, 50)")
+        self.browser.wait_for_js("document.title == 'changed'", timeout=1.0)
+
     def test_click(self):
         self.browser.click("#link")
         self.browser.wait_load(timeout=1.0)
@@ -123,11 +240,91 @@ class SpynnerBrowserTest(unittest.TestCase):
         self.assertEqual(get_url('/test2.html?user=%s' % name), 
             self.browser.url)            
                 
+    def test_fill_with_jquery_selector(self):
+        self.browser.fill("input[type=text]:first", "myname")
+        jscode = "jQuery('input[name=user]').val()"
+        self.assertEqual("myname", self.browser.runjs(jscode).toString())
+
+    def test_query(self):
+        element = self.browser.query("#link")
+        self.assertEqual("a", unicode(element.tagName()).lower())
+        self.assertEqual(None, self.browser.query("#nonexisting"))
+        self.assertEqual(3, len(self.browser.query_all("input[type=radio]")))
+
+    def test_get_attribute_and_text(self):
+        self.assertEqual("/test3.html", 
+            self.browser.get_attribute("#link", "href"))
+        self.assertEqual(None, self.browser.get_attribute("#link", "title"))
+        self.assertEqual("link", self.browser.get_text("#link"))
+        self.assertRaises(spynner.SpynnerError, 
+            self.browser.get_text, "#nonexisting")
+
+    def test_set_value_and_evaluate_on(self):
+        self.browser.set_value("input[name=user]", "myname")
+        values = self.browser.evaluate_on("input[name=user]", "this.value")
+        self.assertEqual(["myname"], [value.toString() for value in values])
+
+    def test_fill_form(self):
+        results = self.browser.fill_form({"input[name=user]": "myname", 
+            "#nonexisting": "value"}, check=["#check"], choose=["#radio2"])
+        self.assertEqual({"input[name=user]": True, "#nonexisting": False, 
+            "#check": True, "#radio2": True}, results)
+        jscode = "jQuery('input[name=user]').val()"
+        self.assertEqual("myname", self.browser.runjs(jscode).toString())
+        jscode = "jQuery('#check').attr('checked')"
+        self.assertTrue(self.browser.runjs(jscode).toPyObject())
+
+    def test_batch(self):
+        with self.browser.batch() as batch:
+            batch.select("#select option[value=2]")
+            batch.uncheck("#check")
+        self.assertEqual([("select", "#select option[value=2]", True), 
+            ("uncheck", "#check", True)], batch.results)
+        jscode = "jQuery('#option2').attr('selected')"
+        self.assertTrue(self.browser.runjs(jscode).toPyObject())
+
     def test_runjs(self):
         jscode = "document.getElementById('link').innerHTML = 'hello there!'" 
         self.browser.runjs(jscode)
         self.assertTrue("hello there!" in self.browser.html)
 
+    def test_jquery_injected_on_load(self):
+        jscode = "typeof %s" % self.browser.jslib
+        self.assertEqual("function", self.browser.runjs(jscode).toString())
+
+    def test_jquery_of_the_page_is_kept(self):
+        self.assertTrue(self.browser.load(get_url("/test5.html")))
+        self.assertEqual("ready", self.browser.evaluate("document.title"))
+        self.assertEqual("page", 
+            self.browser.evaluate("jQuery('#text').pagePlugin()"))
+        jscode = "%s !== jQuery" % self.browser.jslib
+        self.assertEqual(True, self.browser.evaluate(jscode))
+        jscode = "%s('#text').length" % self.browser.jslib
+        self.assertEqual(1, self.browser.evaluate(jscode))
+
+    def test_lazy_jquery(self):
+        self.browser.lazy_jquery = True
+        self.browser.load(get_url("/test1.html"))
+        jscode = "typeof %s" % self.browser.jslib
+        self.assertEqual("undefined", self.browser.runjs(jscode).toString())
+        self.browser.check("#check")
+        self.assertEqual("function", self.browser.runjs(jscode).toString())
+
+    def test_evaluate(self):
+        self.assertEqual(2, self.browser.evaluate("1 + 1"))
+        self.assertEqual({"a": [1, "b"]}, 
+            self.browser.evaluate("({a: [1, 'b']})"))
+        self.assertEqual(None, self.browser.evaluate("var x = 1"))
+        self.assertEqual(1, self.browser.evaluate("x"))
+        self.assertRaises(spynner.SpynnerJavascriptError,
+            self.browser.evaluate, "nonexisting_function()")
+
+    def test_extract(self):
+        data = self.browser.extract({"title": "title", 
+            "radios": ("input[type=radio]", "id")})
+        self.assertEqual({"title": ["Test1 HTML"], 
+            "radios": ["radio1", "radio2", "radio3"]}, data)
+
     def test_get_cookies(self):
         cookies = self.browser.get_cookies()
         self.assertTrue("# Netscape HTTP Cookie File" in cookies)
@@ -143,6 +340,73 @@ class SpynnerBrowserTest(unittest.TestCase):
         self.assertTrue("mycookie" not in cookies)
         self.assertTrue("MOZILLA_ID" in cookies)
 
+    def test_sqlite_cookie_jar(self):
+        path = tempfile.mktemp(suffix=".db")
+        try:
+            jar = spynner.SqliteCookieJar(path)
+            self.browser.set_cookie_jar(jar)
+            self.browser.load(get_url("/test1.html"))
+            jar.close()
+            jar2 = spynner.SqliteCookieJar(path)
+            cookies = jar2.cookiesForUrl(QUrl(get_url("/test1.html")))
+            self.assertEqual(["mycookie"], [str(c.name()) for c in cookies])
+            self.assertEqual("12345", str(cookies[0].value()))
+            jar2.close()
+        finally:
+            os.remove(path)
+
+    def test_sqlite_cookie_jar_expire(self):
+        path = tempfile.mktemp(suffix=".db")
+        try:
+            jar = spynner.SqliteCookieJar(path)
+            jar.setMozillaCookies(
+                ".old.com\tTRUE\t/\tFALSE\t946684799\tOLD\t1\n" + 
+                ".new.com\tTRUE\t/\tFALSE\t%d\tNEW\t1" % (time.time() + 3600))
+            jar.expire()
+            cookies = jar.mozillaCookies()
+            self.assertTrue("OLD" not in cookies)
+            self.assertTrue("NEW" in cookies)
+            jar.close()
+        finally:
+            os.remove(path)
+
+    def test_save_and_load_session(self):
+        path = tempfile.mktemp(suffix=".session")
+        self.browser.runjs("sessionStorage.setItem('token', 'abc')")
+        try:
+            self.browser.save_session(path)
+            browser2 = spynner.Browser()
+            try:
+                self.assertTrue(browser2.load_session(path))
+                self.assertEqual(get_url("/test1.html"), browser2.url)
+                self.assertTrue("mycookie" in browser2.get_cookies())
+                self.assertEqual("abc", 
+                    browser2.evaluate("sessionStorage.getItem('token')"))
+            finally:
+                browser2.close()
+        finally:
+            os.remove(path)
+
+    def test_session_file_is_private(self):
+        path = tempfile.mktemp(suffix=".session")
+        open(path, "w").close()
+        os.chmod(path, 0644)
+        try:
+            self.browser.save_session(path)
+            if os.name == "posix":
+                self.assertEqual(0600, os.stat(path).st_mode & 0777)
+        finally:
+            os.remove(path)
+
+    def test_load_session_raises_exception_on_invalid_file(self):
+        path = tempfile.mktemp(suffix=".session")
+        open(path, "w").write("not a session")
+        try:
+            self.assertRaises(spynner.SpynnerError, 
+                self.browser.load_session, path)
+        finally:
+            os.remove(path)
+
     def test_javascript_console_message(self):
         self.browser.runjs("console.log('hello there!')")
         output = self.get_debug()
@@ -155,6 +419,47 @@ class SpynnerBrowserTest(unittest.TestCase):
         self.assertTrue("Javascript alert" in output)
         self.assertTrue("hello there!" in output)        
 
+    def test_debug_level_discards_lines(self):
+        self.browser.debug_level = spynner.ERROR
+        self.browser.runjs("console.log('hello there!')")
+        self.assertTrue("hello there!" not in self.get_debug())
+
+    def test_debug_logging(self):
+        output = StringIO()
+        handler = logging.StreamHandler(output)
+        logger = logging.getLogger("spynner")
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        try:
+            self.browser.debug_level = spynner.ERROR
+            self.browser.runjs("console.log('hello there!')")
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(logging.NOTSET)
+        self.assertTrue("hello there!" in output.getvalue())
+        self.assertTrue("hello there!" not in self.get_debug())
+
+    def test_browsers_share_logger(self):
+        loggers = len(logging.Logger.manager.loggerDict)
+        browser = spynner.Browser(debug_level=spynner.INFO)
+        browser.debug_stream = StringIO()
+        browser.runjs("console.log('other browser')")
+        browser.close()
+        self.assertEqual(loggers, len(logging.Logger.manager.loggerDict))
+        self.assertTrue("other browser" in browser.debug_stream.getvalue())
+        self.assertTrue("other browser" not in self.get_debug())
+
+    def test_debug_stream_does_not_propagate(self):
+        output = StringIO()
+        handler = logging.StreamHandler(output)
+        logging.getLogger("spynner").addHandler(handler)
+        try:
+            self.browser.runjs("console.log('hello there!')")
+        finally:
+            logging.getLogger("spynner").removeHandler(handler)
+        self.assertTrue("hello there!" not in output.getvalue())
+        self.assertTrue("hello there!" in self.get_debug())
+
     def test_download(self):
         outfd = StringIO()
         downloaded_bytes = self.browser.download(get_url('/test3.html'), outfd)
@@ -162,10 +467,126 @@ class SpynnerBrowserTest(unittest.TestCase):
         self.assertEqual(len(expected_data), downloaded_bytes)
         self.assertEqual(expected_data, outfd.getvalue())
 
+    def test_download_ignores_resource_policy(self):
+        self.browser.set_resource_policy(["stylesheet"])
+        data = self.browser.download(get_url('/test.css'))
+        self.assertEqual(open(get_file_path('test.css')).read(), data)
+
+    def test_download_with_progress(self):
+        calls = []
+        def progress(nbytes, total, rate):
+            calls.append((nbytes, total))
+        data = self.browser.download(get_url('/test3.html'), progress=progress)
+        self.assertEqual(len(data), calls[-1][0])
+
+    def test_download_with_offset(self):
+        expected_data = open(get_file_path('test3.html')).read()
+        data = self.browser.download(get_url('/test3.html'), offset=10)
+        self.assertEqual(expected_data[10:], data)
+
+    def test_iter_download(self):
+        chunks = list(self.browser.iter_download(get_url('/test3.html'), 16))
+        expected_data = open(get_file_path('test3.html')).read()
+        self.assertTrue(max(len(chunk) for chunk in chunks) <= 16)
+        self.assertEqual(expected_data, "".join(chunks))
+
+    def test_download_many(self):
+        urls = [get_url('/test%d.html' % n) for n in (1, 2, 3)] + \
+            [get_url('/nonexisting.out')]
+        outfds = dict((url, StringIO()) for url in urls)
+        results = self.browser.download_many(urls, per_host=2, outfds=outfds)
+        self.assertEqual(urls, [result.url for result in results])
+        self.assertEqual([True, True, True, False], 
+            [result.status for result in results])
+        expected_data = open(get_file_path('test3.html')).read()
+        self.assertEqual(len(expected_data), results[2].nbytes)
+        self.assertEqual(expected_data, outfds[urls[2]].getvalue())
+
+    def test_download_many_with_repeated_urls(self):
+        url = get_url('/test1.html')
+        chunks = []
+        results = self.browser.download_many([url, url], 
+            callback=lambda url, data: chunks.append(data))
+        self.assertEqual([url, url], [result.url for result in results])
+        self.assertEqual(open(get_file_path('test1.html')).read(), 
+            "".join(chunks))
+
+    def test_download_many_with_invalid_limits(self):
+        urls = [get_url('/test1.html')]
+        self.assertRaises(ValueError, self.browser.download_many, urls, 
+            max_concurrency=0)
+        self.assertRaises(ValueError, self.browser.idownload_many, urls, 
+            per_host=0)
+
+    def test_download_many_with_failed_requests(self):
+        urls = ["unknown://server/file%d" % n for n in range(3)]
+        results = self.browser.download_many(urls, outfds=dict((url, 
+            StringIO()) for url in urls))
+        self.assertEqual([False, False, False], 
+            [result.status for result in results])
+
     def test_download_error(self):
         outfd = StringIO()
         downloaded_bytes = self.browser.download(get_url('/nonexisting.out'), outfd)
         self.assertEqual(None, downloaded_bytes)
+        self.assertEqual("", outfd.getvalue())
+
+    def test_iter_download_error(self):
+        chunks = []
+        def _download():
+            for chunk in self.browser.iter_download(get_url('/nonexisting.out')):
+                chunks.append(chunk)
+        self.assertRaises(spynner.SpynnerError, _download)
+        self.assertEqual([], chunks)
+
+    def test_download_file_error(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "file.out")
+            url = get_url('/nonexisting.out')
+            self.assertEqual(None, self.browser.download_file(url, path))
+            self.assertFalse(os.path.exists(path))
+            open(path, "w").write("partial")
+            self.assertEqual(None, self.browser.download_file(url, path))
+            self.assertEqual("partial", open(path).read())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.browser.enable_cache(directory, force_static=True)
+            self.browser.load(get_url("/test2.html"))
+            self.browser.load(get_url("/test2.html"))
+            self.assertTrue(self.browser.cache_hits >= 1)
+            self.assertTrue(self.browser.cache_misses >= 1)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_cache_evicts_least_recently_used(self):
+        directory = tempfile.mkdtemp()
+        def insert(url, size):
+            metadata = QNetworkCacheMetaData()
+            metadata.setUrl(QUrl(url))
+            metadata.setSaveToDisk(True)
+            device = cache.prepare(metadata)
+            device.write("x" * size)
+            cache.insert(device)
+        try:
+            cache = spynner.browser._LRUDiskCache()
+            cache.setCacheDirectory(directory)
+            cache.setMaximumCacheSize(50000)
+            insert("http://server.com/a", 20000)
+            insert("http://server.com/b", 20000)
+            time.sleep(0.01)
+            cache.data(QUrl("http://server.com/a")).close()
+            insert("http://server.com/c", 20000)
+            self.assertTrue(cache.cacheSize() <= 50000)
+            self.assertTrue(cache.metaData(QUrl("http://server.com/a")).isValid())
+            self.assertFalse(cache.metaData(QUrl("http://server.com/b")).isValid())
+            self.assertTrue(cache.metaData(QUrl("http://server.com/c")).isValid())
+        finally:
+            shutil.rmtree(directory)
 
     def test_get_url_from_path(self):
         self.assertEqual(get_url("/test2.html"), 
@@ -179,6 +600,41 @@ class SpynnerBrowserTest(unittest.TestCase):
         self.browser.load(get_url("/test2.html"))
         # do some test here!
         
+    def test_set_url_rules(self):
+        self.browser.set_url_rules(["/test.css|"])
+        self.assertTrue(self.browser.load(get_url("/test2.html")))
+        self.assertTrue("URL blocked: %s" % get_url("/test.css") in self.get_debug())
+
+    def test_blocked_reply_abort_emits_finished(self):
+        self.browser.set_url_rules(["||blocked.com^"])
+        request = QNetworkRequest(QUrl("http://blocked.com/ad.js"))
+        reply = self.browser.manager.get(request)
+        finished = []
+        reply.connect(reply, SIGNAL("finished()"), lambda: finished.append(1))
+        reply.abort()
+        self.browser.wait(0.05)
+        self.assertEqual([1], finished)
+        self.assertFalse(reply in self.browser._inflight_requests)
+
+    def test_set_resource_policy(self):
+        self.browser.set_resource_policy(["stylesheet"])
+        self.assertTrue(self.browser.load(get_url("/test2.html")))
+        self.assertEqual(1, self.browser.resource_stats["blocked_requests"])
+        self.assertTrue("Resource blocked (stylesheet)" in self.get_debug())
+
+    def test_fast_profile(self):
+        browser = spynner.Browser(profile="fast")
+        try:
+            self.assertTrue(browser.load(get_url("/test4.html")))
+            # The stylesheet request and two (distinct) images
+            self.assertEqual(3, browser.resource_stats["blocked_requests"])
+            urls = [record.url for record in browser.requests]
+            self.assertFalse([url for url in urls if url.endswith(".png")])
+            # Scripts are not blocked
+            self.assertEqual("Test4 loaded", unicode(browser.webframe.title()))
+        finally:
+            browser.close()
+
     def test_javascript_confirm(self):
         def confirm_no(url, message):
             return False
@@ -215,6 +671,42 @@ class SpynnerBrowserTest(unittest.TestCase):
         self.browser.set_html_parser(my_parser)
         self.assertEqual(self.browser.html.splitlines(), self.browser.soup)
         
+    def test_soup_is_cached(self):
+        calls = []
+        def my_parser(html):
+            calls.append(html)
+            return html.splitlines()
+        self.browser.set_html_parser(my_parser)
+        self.assertTrue(self.browser.soup is self.browser.soup)
+        self.assertEqual(1, len(calls))
+        self.browser.invalidate_soup()
+        self.browser.soup
+        self.assertEqual(2, len(calls))
+
+    def test_prefetch_soup(self):
+        self.browser.set_html_parser(lambda html: html.splitlines())
+        self.browser.prefetch_soup = True
+        self.browser.load(get_url("/test2.html"))
+        self.assertEqual(self.browser.html.splitlines(), self.browser.soup)
+
+    def test_stale_soup_prefetch_is_discarded(self):
+        release = threading.Event()
+        def parser(html):
+            if "first" in html:
+                release.wait(5.0)
+            return html
+        self.browser.set_html_parser(parser)
+        self.browser.runjs("document.title = 'first'")
+        self.browser._start_soup_prefetch()
+        first_thread = self.browser._soup_thread
+        self.browser.runjs("document.title = 'second'")
+        self.browser._start_soup_prefetch()
+        self.browser._soup_thread.join()
+        release.set()
+        first_thread.join()
+        self.assertTrue("second" in self.browser._soup_cache[1])
+        self.assertTrue("second" in self.browser.soup)
+
     def test_html_contains(self):
         self.assertTrue(self.browser.html_contains("function SetCookie"))
         self.assertTrue(self.browser.html_contains("func.ion [Ss]etCookie"))
@@ -252,7 +744,214 @@ class SpynnerBrowserTest(unittest.TestCase):
         image = self.browser.snapshot((100, 100, 200, 250))
         self.assertTrue(type(image) == QImage)
         self.assertEqual((image.width(), image.height()), (100, 150))
+
+    def test_snapshot_tiles(self):
+        tiles = []
+        def callback(image, x, y):
+            tiles.append((x, y, image.width(), image.height()))
+        size = self.browser.webframe.contentsSize()
+        ntiles = self.browser.snapshot_tiles(callback, (100, 100))
+        self.assertEqual(len(tiles), ntiles)
+        self.assertEqual((0, 0, 100, 100), tiles[0])
+        self.assertEqual(size.width() * size.height(), 
+            sum(width * height for (x, y, width, height) in tiles))
+
+    def test_snapshot_async(self):
+        directory = tempfile.mkdtemp()
+        saved = []
+        def callback(path, success):
+            saved.append((path, success))
+        try:
+            paths = [os.path.join(directory, "snapshot%d.png" % n) 
+                for n in range(3)]
+            for path in paths:
+                self.browser.snapshot_async(path, callback=callback)
+            self.browser.wait_snapshots(timeout=5.0)
+            self.assertEqual(sorted(paths), sorted(path for (path, ok) in saved))
+            self.assertTrue(all(ok for (path, ok) in saved))
+            image = QImage(paths[0])
+            self.assertEqual(self.browser.webpage.viewportSize(), image.size())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_snapshot_array(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("NumPy is not installed")
+        array = self.browser.snapshot_array((100, 100, 200, 250))
+        self.assertEqual((150, 100, 4), array.shape)
+        self.assertEqual(numpy.uint8, array.dtype)
+        array2 = self.browser.snapshot_array((0, 0, 100, 150))
+        self.assertTrue(array is array2)
+        array3 = self.browser.snapshot_array((0, 0, 100, 150), reuse=False)
+        self.assertFalse(array is array3)
+        self.assertTrue((array2 == array3).all())
         
+
+class SpynnerUrlRulesTest(unittest.TestCase):
+    def test_domains(self):
+        rules = spynner.browser._UrlRules(["ads.com", "||tracker.net^"])
+        self.assertTrue(rules.match("http://ads.com/banner.png"))
+        self.assertTrue(rules.match("http://www.ads.com/"))
+        self.assertTrue(rules.match("https://a.b.tracker.net/t.gif"))
+        self.assertFalse(rules.match("http://notads.com/"))
+        
+    def test_patterns(self):
+        rules = spynner.browser._UrlRules(["/ad[0-9]+\\.js/", "/banner/*.gif", 
+            "|http://example.org/tracker^", "! comment", "foo$script"])
+        self.assertTrue(rules.match("http://server.com/ad12.js"))
+        self.assertTrue(rules.match("http://server.com/img/banner/top.gif"))
+        self.assertTrue(rules.match("http://example.org/tracker?id=1"))
+        self.assertFalse(rules.match("http://example.org/trackers"))
+        self.assertFalse(rules.match("http://server.com/foo"))
+
+    def test_exceptions(self):
+        rules = spynner.browser._UrlRules(["||ads.com^", "@@||good.ads.com^"])
+        self.assertTrue(rules.match("http://ads.com/"))
+        self.assertFalse(rules.match("http://good.ads.com/"))
+
+    def test_regexp_with_end_anchor(self):
+        rules = spynner.browser._UrlRules(["/\\.exe$/"])
+        self.assertTrue(rules.match("http://x.com/setup.exe"))
+        self.assertFalse(rules.match("http://x.com/setup.exe.html"))
+
+    def test_large_rule_set(self):
+        rules = ["/banner%d/*.gif" % n for n in range(10000)] + \
+            ["||tracker%d.net/pixel^" % n for n in range(10000)] + \
+            ["|http://cdn.com/ads/%d.js|" % n for n in range(10000)]
+        itime = time.time()
+        url_rules = spynner.browser._UrlRules(rules)
+        self.assertTrue(time.time() - itime < 2.0)
+        itime = time.time()
+        for n in range(100):
+            self.assertTrue(url_rules.match("http://s.com/banner%d/a.gif" % n))
+            self.assertTrue(url_rules.match("http://a.tracker%d.net/pixel?x" % n))
+            self.assertFalse(url_rules.match("http://cdn.com/ads/%d.json" % n))
+        self.assertTrue(time.time() - itime < 0.5)
+
+class SpynnerMetricsTest(unittest.TestCase):
+    def test_histogram(self):
+        histogram = spynner.metrics.Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        self.assertEqual([2, 1, 1], histogram.counts)
+        self.assertEqual(4, histogram.count)
+
+    def test_parent_is_updated(self):
+        parent = spynner.metrics.Metrics()
+        metrics = spynner.metrics.Metrics(parent)
+        metrics.inc("downloads_total")
+        metrics.observe("download_seconds", 0.2)
+        self.assertEqual(1, parent.counters["downloads_total"])
+        self.assertEqual(1, parent.histograms["download_seconds"].count)
+
+    def test_to_prometheus(self):
+        metrics = spynner.metrics.Metrics()
+        metrics.inc("pages_loaded_total", 3)
+        metrics.observe("page_load_seconds", 0.3)
+        text = metrics.to_prometheus()
+        self.assertTrue("# TYPE spynner_pages_loaded_total counter" in text)
+        self.assertTrue("spynner_pages_loaded_total 3\n" in text)
+        self.assertTrue('spynner_page_load_seconds_bucket{le="0.25"} 0\n' in text)
+        self.assertTrue('spynner_page_load_seconds_bucket{le="0.5"} 1\n' in text)
+        self.assertTrue('spynner_page_load_seconds_bucket{le="+Inf"} 1\n' in text)
+        self.assertTrue("spynner_page_load_seconds_count 1\n" in text)
+
+# Farm actions (module-level functions, so they can be pickled)
+
+def _farm_crash(browser):
+    os.kill(os.getpid(), signal.SIGKILL)
+
+def _farm_block(browser):
+    # Until the worker is killed
+    signal.pause()
+
+def _farm_unpicklable(browser):
+    return lambda: None
+
+def _farm_failing_init(browser):
+    raise ValueError("init failed")
+
+# Workers are forked, so farm tests must run before any browser is 
+# created in the test process (test cases run in alphabetical order).
+class SpynnerBrowserFarmTest(unittest.TestCase):
+    def tearDown(self):
+        self.farm.close()
+
+    def run_jobs(self, jobs, **kwargs):
+        """Run jobs C{(name, url, actions)}, return results by name."""
+        self.farm = spynner.farm.BrowserFarm(processes=1, **kwargs)
+        names = dict((self.farm.submit(url, actions), name) 
+            for (name, url, actions) in jobs)
+        return dict((names[result.job_id], result) 
+            for result in self.farm.results())
+
+    def test_job(self):
+        url = get_url("/test1.html")
+        results = self.run_jobs([("job", url, [("url",), ("html",)])])
+        result = results["job"]
+        self.assertEqual(None, result.error)
+        self.assertTrue(result.status)
+        self.assertEqual(url, result.values[0])
+        self.assertTrue("Test1 HTML" in result.values[1])
+
+    def test_workers_are_recycled(self):
+        url = get_url("/test1.html")
+        results = self.run_jobs([("job1", url, []), ("job2", url, [])], 
+            max_pages=1)
+        self.assertEqual([None, None], 
+            [result.error for result in results.values()])
+        self.assertEqual(2, len(set(result.pid for result in results.values())))
+
+    def test_crashed_job_is_retried(self):
+        results = self.run_jobs([("crash", None, [_farm_crash]), 
+            ("load", get_url("/test1.html"), [])], max_retries=1)
+        self.assertTrue("Worker crashed" in results["crash"].error)
+        self.assertEqual(2, results["crash"].attempts)
+        self.assertEqual(None, results["load"].error)
+
+    def test_job_timeout(self):
+        results = self.run_jobs([("block", None, [_farm_block])], 
+            max_retries=0, job_timeout=5.0)
+        self.assertTrue("Job timeout" in results["block"].error)
+
+    def test_unpicklable_values(self):
+        results = self.run_jobs([("unpicklable", None, [_farm_unpicklable]), 
+            ("load", get_url("/test1.html"), [])])
+        self.assertTrue(results["unpicklable"].error)
+        self.assertEqual(None, results["load"].error)
+
+    def test_init_error(self):
+        self.farm = spynner.farm.BrowserFarm(processes=1, 
+            init=_farm_failing_init)
+        self.farm.submit(get_url("/test1.html"))
+        self.assertRaises(spynner.SpynnerError, list, self.farm.results())
+
+class SpynnerBrowserPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = spynner.BrowserPool(2)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_map(self):
+        urls = [get_url("/test%d.html" % n) for n in (1, 2, 3)]
+        results = self.pool.map(lambda browser: browser.url, urls)
+        self.assertEqual(urls, results)
+
+    def test_run_should_return_jobs_with_status(self):
+        job1 = self.pool.submit(get_url("/test1.html"))
+        job2 = self.pool.submit("wrong://this-cannot-work")
+        self.assertEqual([job1, job2], self.pool.run())
+        self.assertTrue(job1.done and job1.status)
+        self.assertFalse(job2.status)
+
+    def test_shared_cookies(self):
+        self.pool.map(None, [get_url("/test1.html")])
+        for browser in self.pool.browsers:
+            self.assertTrue("mycookie" in browser.get_cookies())
+
         
 def suite():                                            
     return unittest.TestLoader().loadTestsFromTestCase(SpynnerBrowserTest)